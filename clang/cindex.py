@@ -1520,6 +1520,15 @@ class _CXUnsavedFile(Structure):
     """Helper for passing unsaved file arguments."""
     _fields_ = [("name", c_char_p), ("contents", c_char_p), ('length', c_ulong)]
 
+class _CXTUResourceUsageEntry(Structure):
+    """Helper for reading the memory usage of a translation unit."""
+    _fields_ = [("kind", c_int), ("amount", c_ulong)]
+
+class _CXTUResourceUsage(Structure):
+    """Helper for reading the memory usage of a translation unit."""
+    _fields_ = [("data", c_void_p), ("numEntries", c_uint),
+                ("entries", POINTER(_CXTUResourceUsageEntry))]
+
 ## Diagnostic Conversion ##
 
 _clang_getNumDiagnostics = lib.clang_getNumDiagnostics
@@ -1867,6 +1876,33 @@ class TranslationUnit(ClangObject):
 
         return DiagIterator(self)
 
+    def get_file(self, filename):
+        """Return the File object for the given file name, or None."""
+        obj = _clang_getFile(self, filename)
+        if not obj:
+            return None
+        return File(obj)
+
+    def save(self, filename):
+        """
+        Save the translation unit to the given AST file, which can later be
+        loaded with Index.read. Returns True if the file was saved.
+        """
+        return TranslationUnit_save(self, filename,
+                                    TranslationUnit_defaultSaveOptions(self)) == 0
+
+    def get_memory_usage(self):
+        """
+        Return the number of bytes of memory currently used by this
+        translation unit, as reported by clang_getCXTUResourceUsage.
+        """
+        usage = TranslationUnit_resourceUsage(self)
+        total = 0
+        for i in range(usage.numEntries):
+            total += usage.entries[i].amount
+        TranslationUnit_disposeResourceUsage(usage)
+        return total
+
     def reparse(self, unsaved_files = [], options = 0):
         """
         Reparse an already parsed translation unit.
@@ -2285,6 +2321,23 @@ TranslationUnit_spelling.errcheck = _CXString.from_result
 TranslationUnit_dispose = lib.clang_disposeTranslationUnit
 TranslationUnit_dispose.argtypes = [TranslationUnit]
 
+TranslationUnit_defaultSaveOptions = lib.clang_defaultSaveOptions
+TranslationUnit_defaultSaveOptions.argtypes = [TranslationUnit]
+TranslationUnit_defaultSaveOptions.restype = c_uint
+
+TranslationUnit_save = lib.clang_saveTranslationUnit
+TranslationUnit_save.argtypes = [TranslationUnit, c_char_p, c_uint]
+TranslationUnit_save.restype = c_int
+
+TranslationUnit_resourceUsage = lib.clang_getCXTUResourceUsage
+TranslationUnit_resourceUsage.argtypes = [TranslationUnit]
+TranslationUnit_resourceUsage.restype = _CXTUResourceUsage
+
+TranslationUnit_disposeResourceUsage = lib.clang_disposeCXTUResourceUsage
+TranslationUnit_disposeResourceUsage.argtypes = [_CXTUResourceUsage]
+if isWin64:
+    TranslationUnit_disposeResourceUsage.argtypes = [POINTER(_CXTUResourceUsage)]
+
 TranslationUnit_includes_callback = CFUNCTYPE(None,
                                               c_object_p,
                                               POINTER(SourceLocation),
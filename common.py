@@ -23,10 +23,14 @@ freely, subject to the following restrictions:
 
 import threading
 import time
-import Queue
+import heapq
 import os
 import re
 
+# The workers don't take any tasks until this is set, which is done
+# once the plugin has been loaded so that they don't compete with the
+# editor while it's starting up
+workersReady = threading.Event()
 
 try:
     import sublime
@@ -62,6 +66,14 @@ try:
     def status_message(msg):
         sublime.status_message(msg)
 
+    def find_views(filename):
+        views = []
+        for window in sublime.windows():
+            for view in window.views():
+                if view.file_name() == filename:
+                    views.append(view)
+        return views
+
     def get_settings():
         return sublime.load_settings("SublimeClang.sublime-settings")
 
@@ -126,9 +138,14 @@ except:
     def status_message(msg):
         print msg
 
+    def find_views(filename):
+        return []
+
     def expand_path(value, window):
         return value
 
+    workersReady.set()
+
 
 class LockedVariable:
     def __init__(self, var):
@@ -146,11 +163,220 @@ class LockedVariable:
         self.l.release()
 
 
+class ReadWriteLock:
+    """
+    A lock that any number of readers can hold at the same time, or a
+    single writer. acquire and release take and give back the write lock
+    so that it can stand in for a threading.Lock. Waiting writers are
+    let in before new readers so that they aren't starved.
+    """
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    def acquire_read(self, blocking=True):
+        self.condition.acquire()
+        try:
+            while self.writer or self.waiting_writers:
+                if not blocking:
+                    return False
+                self.condition.wait()
+            self.readers += 1
+            return True
+        finally:
+            self.condition.release()
+
+    def release_read(self):
+        self.condition.acquire()
+        try:
+            self.readers -= 1
+            if self.readers == 0:
+                self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    def acquire(self, blocking=True):
+        self.condition.acquire()
+        try:
+            if self.writer or self.readers:
+                if not blocking:
+                    return False
+                self.waiting_writers += 1
+                try:
+                    while self.writer or self.readers:
+                        self.condition.wait()
+                finally:
+                    self.waiting_writers -= 1
+            self.writer = True
+            return True
+        finally:
+            self.condition.release()
+
+    def release(self):
+        self.condition.acquire()
+        try:
+            self.writer = False
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+
+class ReadWriteLockedVariable(LockedVariable):
+    """
+    A LockedVariable that can also be locked for reading only. lock,
+    try_lock and unlock give exclusive access.
+    """
+    def __init__(self, var):
+        LockedVariable.__init__(self, var)
+        self.l = ReadWriteLock()
+
+    def try_lock_read(self):
+        return self.l.acquire_read(False)
+
+    def lock_read(self):
+        self.l.acquire_read()
+        return self.var
+
+    def unlock_read(self):
+        self.l.release_read()
+
+
+# Task priorities, lower values are run first
+PRIORITY_FOREGROUND = 0  # The view currently being edited
+PRIORITY_VISIBLE    = 1  # Other visible views
+PRIORITY_BACKGROUND = 2  # Warm up of views not visible
+PRIORITY_SEARCH     = 3  # Searching and indexing
+
+# The pools sharing the execution budget
+POOL_TRANSLATION_UNIT = "translationunit"  # Parsing and reparsing
+POOL_ANALYZER         = "analyzer"         # The static analyzer
+POOL_SEARCH           = "search"           # Extensive searches
+
+
+class Task(object):
+    def __init__(self, func, data, priority, key, seq):
+        self.func = func
+        self.data = data
+        self.priority = priority
+        self.key = key
+        self.seq = seq
+        self.cancelled = False
+        self.started = False
+
+
+class TaskQueue:
+    """
+    A queue of tasks that hands out the tasks with the highest priority
+    first, and tasks of the same priority in the order they were added.
+    Tasks that haven't been started yet can be cancelled or moved to
+    another priority via the key they were added with.
+
+    Tasks with the same key are never run at the same time. A task whose
+    key is busy is put aside without losing its place in the queue and
+    handed out as soon as the running task with that key is done.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.heap = []
+        self.keys = {}
+        self.running = set()
+        self.blocked = {}
+        self.seq = 0
+        self.queued = 0
+
+    def put(self, func, data=None, priority=PRIORITY_BACKGROUND, key=None):
+        self.condition.acquire()
+        try:
+            task = Task(func, data, priority, key, self.seq)
+            self.seq += 1
+            heapq.heappush(self.heap, (priority, task.seq, task))
+            if key != None:
+                self.keys.setdefault(key, []).append(task)
+            self.queued += 1
+            self.condition.notify()
+            return task
+        finally:
+            self.condition.release()
+
+    def get(self):
+        self.condition.acquire()
+        try:
+            while True:
+                while len(self.heap) == 0:
+                    self.condition.wait()
+                priority, seq, task = heapq.heappop(self.heap)
+                # Cancelled tasks and entries left behind when a task
+                # was moved to another priority are just skipped
+                if task.cancelled or task.started or task.priority != priority:
+                    continue
+                if task.key in self.running:
+                    self.blocked.setdefault(task.key, []).append((priority, seq, task))
+                    continue
+                if task.key != None:
+                    self.running.add(task.key)
+                task.started = True
+                self.remove_key(task)
+                self.queued -= 1
+                return task
+        finally:
+            self.condition.release()
+
+    def task_done(self, task):
+        if task.key == None:
+            return
+        self.condition.acquire()
+        try:
+            self.running.discard(task.key)
+            blocked = self.blocked.pop(task.key, [])
+            for entry in blocked:
+                heapq.heappush(self.heap, entry)
+            if len(blocked):
+                self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    def remove_key(self, task):
+        if task.key != None:
+            tasks = self.keys[task.key]
+            tasks.remove(task)
+            if len(tasks) == 0:
+                del self.keys[task.key]
+
+    def cancel(self, key):
+        """Cancels the queued tasks with the given key and returns them"""
+        self.condition.acquire()
+        try:
+            tasks = self.keys.pop(key, [])
+            for task in tasks:
+                task.cancelled = True
+            self.queued -= len(tasks)
+            return tasks
+        finally:
+            self.condition.release()
+
+    def set_priority(self, key, priority):
+        """Moves the queued tasks with the given key to another priority"""
+        self.condition.acquire()
+        try:
+            for task in self.keys.get(key, []):
+                if task.priority != priority:
+                    task.priority = priority
+                    heapq.heappush(self.heap, (priority, task.seq, task))
+        finally:
+            self.condition.release()
+
+    def empty(self):
+        return self.queued == 0
+
+
 class Worker(object):
-    def __init__(self, threadcount=-1):
+    def __init__(self, threadcount=-1, pool=None):
         if threadcount < 1:
             threadcount = get_cpu_count()
-        self.tasks = Queue.Queue()
+        self.pool = pool
+        self.tasks = TaskQueue()
         for i in range(threadcount):
             t = threading.Thread(target=self.worker)
             t.daemon = True
@@ -164,45 +390,233 @@ class Worker(object):
         run_in_main_thread(self.display_status)
 
     def worker(self):
-        try:
-            # Just so we give time for the editor itself to start
-            # up before we start doing work
-            time.sleep(5)
-        except:
-            pass
+        workersReady.wait()
         while True:
-            task, data = self.tasks.get()
+            task = self.tasks.get()
+            if self.pool != None:
+                executionBudget.acquire(self.pool, task.priority)
             try:
-                task(data)
+                task.func(task.data)
             except:
                 import traceback
                 traceback.print_exc()
             finally:
-                self.tasks.task_done()
+                if self.pool != None:
+                    executionBudget.release(self.pool)
+                self.tasks.task_done(task)
+
+    def add_task(self, func, data=None, priority=PRIORITY_BACKGROUND, key=None):
+        return self.tasks.put(func, data, priority, key)
+
+    def cancel_tasks(self, key):
+        return self.tasks.cancel(key)
+
+    def set_task_priority(self, key, priority):
+        self.tasks.set_priority(key, priority)
+
+
+class ScheduledCall(object):
+    def __init__(self, scheduler, func, args):
+        self.scheduler = scheduler
+        self.func = func
+        self.args = args
+        self.when = None
+        self.seq = 0
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+    def reschedule(self, delay):
+        self.scheduler.reschedule(self, delay)
+
+
+class TimerScheduler:
+    """
+    Calls functions after a delay from a single thread, rather than
+    starting a thread per call like threading.Timer does. A scheduled
+    call can be cancelled or moved to another time, which makes it
+    cheap to restart a debounce timer on every keystroke.
+
+    The functions are called from the scheduler thread, so they should
+    be quick and hand anything slow over to another thread.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.heap = []
+        self.seq = 0
+        self.thread = None
+
+    def schedule(self, delay, func, *args):
+        """Calls func(*args) in delay seconds and returns the ScheduledCall"""
+        call = ScheduledCall(self, func, args)
+        self.reschedule(call, delay)
+        return call
+
+    def reschedule(self, call, delay):
+        """
+        Moves the call to delay seconds from now, whether it's still
+        pending, has been cancelled or has already been made.
+        """
+        self.condition.acquire()
+        try:
+            if self.thread == None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            # The entry for the old time is left in the heap and
+            # skipped once it comes up
+            call.when = time.time() + delay
+            call.seq = self.seq
+            self.seq += 1
+            heapq.heappush(self.heap, (call.when, call.seq, call))
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def cancel(self, call):
+        self.condition.acquire()
+        try:
+            call.when = None
+        finally:
+            self.condition.release()
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while True:
+                    if len(self.heap) == 0:
+                        self.condition.wait()
+                        continue
+                    when, seq, call = self.heap[0]
+                    if call.when != when or call.seq != seq:
+                        heapq.heappop(self.heap)
+                        continue
+                    now = time.time()
+                    if when > now:
+                        self.condition.wait(when - now)
+                        continue
+                    heapq.heappop(self.heap)
+                    call.when = None
+                    break
+            finally:
+                self.condition.release()
+            try:
+                call.func(*call.args)
+            except:
+                import traceback
+                traceback.print_exc()
+
+timerScheduler = TimerScheduler()
+
+
+# Minimum number of seconds between checks of whether the directories
+# of an expanded "-I<path>/*" or "-I<path>/**" option have been modified
+PATH_CHECK_INTERVAL = 5
+
+
+def get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def expand_include_paths(starting_path, path_last):
+    """
+    Returns the include options of the directories matching the pattern
+    along with the modification times of the directories looked at.
+    """
+    include_paths = []
+    mtimes = {starting_path: get_mtime(starting_path)}
+    if os.path.exists(starting_path):
+        if path_last == "*":
+            for dirname in os.listdir(starting_path):
+                if not dirname.startswith("."):  # skip directories that begin with .
+                    include_paths.append("-I" + os.path.join(starting_path, dirname))
+        elif path_last == "**":
+            for dirpath, dirs, files in os.walk(starting_path):
+                for dirname in list(dirs):
+                    if dirname.startswith("."):  # skip directories that begin with .
+                        dirs.remove(dirname)
+                if dirpath != starting_path:
+                    include_paths.append("-I" + dirpath)
+                    mtimes[dirpath] = get_mtime(dirpath)
+        else:
+            include_paths.append("-I" + starting_path)
+    else:
+        pass  # perhaps put some error here?
+    return include_paths, mtimes
+
+
+class IncludePathCache:
+    """
+    Remembers the expansion of "-I<path>/*" and "-I<path>/**" options so
+    that the directory tree isn't walked every time the options are
+    needed. An expansion is made again once any of the directories it
+    was made from has been modified, or after clear has been called.
+    """
+    def __init__(self):
+        self.entries = LockedVariable({})
+
+    def is_valid(self, entry, now):
+        include_paths, mtimes, checked = entry
+        if now - checked < PATH_CHECK_INTERVAL:
+            return True
+        for path, mtime in mtimes.items():
+            if get_mtime(path) != mtime:
+                return False
+        entry[2] = now
+        return True
+
+    def get(self, window, starting_path, path_last):
+        key = (window.id() if window != None else None, starting_path, path_last)
+        now = time.time()
+        entries = self.entries.lock()
+        try:
+            if key in entries and self.is_valid(entries[key], now):
+                return entries[key][0]
+        finally:
+            self.entries.unlock()
+        include_paths, mtimes = expand_include_paths(starting_path, path_last)
+        entries = self.entries.lock()
+        try:
+            entries[key] = [include_paths, mtimes, now]
+        finally:
+            self.entries.unlock()
+        return include_paths
+
+    def check(self):
+        """
+        Drops the expansions made from directories that have since been
+        modified, and returns True if there were any so that the options
+        built from them can be built again.
+        """
+        now = time.time()
+        entries = self.entries.lock()
+        try:
+            stale = [key for key, entry in entries.items() if not self.is_valid(entry, now)]
+            for key in stale:
+                del entries[key]
+            return len(stale) > 0
+        finally:
+            self.entries.unlock()
+
+    def clear(self):
+        entries = self.entries.lock()
+        try:
+            entries.clear()
+        finally:
+            self.entries.unlock()
+
+includePathCache = IncludePathCache()
 
 
 def complete_path(value, window):
     path_init, path_last = os.path.split(value)
     if path_init[:2] == "-I" and (path_last == "**" or path_last == "*"):
         starting_path = expand_path(path_init[2:], window)
-        include_paths = []
-        if os.path.exists(starting_path):
-            if path_last == "*":
-                for dirname in os.listdir(starting_path):
-                    if not dirname.startswith("."):  # skip directories that begin with .
-                        include_paths.append("-I" + os.path.join(starting_path, dirname))
-            elif path_last == "**":
-                for dirpath, dirs, files in os.walk(starting_path):
-                    for dirname in list(dirs):
-                        if dirname.startswith("."):  # skip directories that begin with .
-                            dirs.remove(dirname)
-                    if dirpath != starting_path:
-                        include_paths.append("-I" + dirpath)
-            else:
-                include_paths.append("-I" + starting_path)
-        else:
-            pass  # perhaps put some error here?
-        return include_paths
+        return list(includePathCache.get(window, starting_path, path_last))
     else:
         return [expand_path(value, window)]
 
@@ -226,3 +640,84 @@ def get_cpu_count():
     except:
         pass
     return cpus
+
+
+class ExecutionBudget:
+    """
+    Limits the number of jobs running at once across all the pools of
+    workers, so that parsing, analyzing and searching at the same time
+    doesn't oversubscribe the cpu. Each pool is also limited to a quota
+    of the budget, which by default is the whole budget. Whatever the
+    quotas, the pools other than the translation units together never
+    get more than all but one slot, so that the file being edited can
+    always be reparsed.
+
+    A freed slot goes to the waiting job with the highest priority that
+    its pool's quota allows to run.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.limit = get_cpu_count()
+        self.quotas = {}
+        self.running = {}
+        self.total = 0
+        self.waiting = []
+        self.seq = 0
+
+    def load_settings(self):
+        limit = get_setting("concurrency_budget", -1)
+        if limit < 1:
+            limit = get_cpu_count()
+        quotas = dict((k, v) for k, v in get_setting("concurrency_quotas", {}).items() if v > 0)
+        self.condition.acquire()
+        try:
+            self.limit = limit
+            self.quotas = quotas
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    def get_quota(self, pool):
+        return self.quotas.get(pool, self.limit)
+
+    def can_run(self, pool):
+        if self.total >= self.limit or self.running.get(pool, 0) >= self.get_quota(pool):
+            return False
+        if pool != POOL_TRANSLATION_UNIT:
+            # With a single slot there's nothing to reserve
+            others = self.total - self.running.get(POOL_TRANSLATION_UNIT, 0)
+            return others < max(1, self.limit - 1)
+        return True
+
+    def is_next(self, entry):
+        if not self.can_run(entry[2]):
+            return False
+        for other in self.waiting:
+            if other < entry and self.can_run(other[2]):
+                return False
+        return True
+
+    def acquire(self, pool, priority=PRIORITY_BACKGROUND):
+        self.condition.acquire()
+        try:
+            entry = (priority, self.seq, pool)
+            self.seq += 1
+            self.waiting.append(entry)
+            while not self.is_next(entry):
+                self.condition.wait()
+            self.waiting.remove(entry)
+            self.running[pool] = self.running.get(pool, 0) + 1
+            self.total += 1
+        finally:
+            self.condition.release()
+
+    def release(self, pool):
+        self.condition.acquire()
+        try:
+            self.running[pool] -= 1
+            self.total -= 1
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+executionBudget = ExecutionBudget()
@@ -0,0 +1,184 @@
+"""
+Copyright (c) 2011-2012 Fredrik Ehnbom
+
+This software is provided 'as-is', without any express or implied
+warranty. In no event will the authors be held liable for any damages
+arising from the use of this software.
+
+Permission is granted to anyone to use this software for any purpose,
+including commercial applications, and to alter it and redistribute it
+freely, subject to the following restrictions:
+
+   1. The origin of this software must not be misrepresented; you must not
+   claim that you wrote the original software. If you use this software
+   in a product, an acknowledgment in the product documentation would be
+   appreciated but is not required.
+
+   2. Altered source versions must be plainly marked as such, and must not be
+   misrepresented as being the original software.
+
+   3. This notice may not be removed or altered from any source
+   distribution.
+"""
+import json
+import os
+import re
+
+SOURCE_EXTENSIONS = (".c", ".cc", ".cpp", ".cxx", ".c++", ".m", ".mm")
+
+flags_pattern = re.compile('(?<=\s)-[DIOUWfgs][^=\s]+(?:=\\"[^"]+\\"|=[^"]\S+)?')
+separators_pattern = re.compile(r'[\s,]*')
+
+
+def normalize_path(path):
+    return os.path.normcase(os.path.normpath(path))
+
+
+def iter_entries(f, chunk_size=1 << 16):
+    """
+    Yields the entries of a compilation database one at a time while
+    reading it in chunks, so that the whole file is never in memory.
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    started = False
+    while True:
+        chunk = f.read(chunk_size)
+        buf += chunk
+        pos = 0
+        while True:
+            pos = separators_pattern.match(buf, pos).end()
+            if pos == len(buf):
+                break
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError("Compilation database is not a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                entry, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if not chunk:
+                    raise
+                # The entry continues in the next chunk
+                break
+            yield entry
+        buf = buf[pos:]
+        if not chunk:
+            if started:
+                raise ValueError("Unexpected end of compilation database")
+            return
+
+
+class CompilationDatabase:
+    """
+    The compile flags of every file in a compile_commands.json. Identical
+    flag lists are shared between files, so a database with many entries
+    compiled with the same flags takes little memory. Files that aren't
+    in the database, such as headers, get the flags of all the files in
+    their directory instead.
+
+    The database can be loaded again when the file changes, in which case
+    only the entries whose command changed are parsed again.
+    """
+    def __init__(self):
+        self.path = None
+        self.stat = None
+        self.files = {}
+        self.folders = {}
+        self.commands = {}
+        self.interned = {}
+
+    def get_stat(self, filename):
+        try:
+            st = os.stat(filename)
+            return (st.st_mtime, st.st_size)
+        except OSError:
+            return None
+
+    def is_modified(self, filename):
+        return filename != self.path or self.get_stat(filename) != self.stat
+
+    def intern(self, opts):
+        opts = tuple(opts)
+        return self.interned.setdefault(opts, opts)
+
+    def get_command_hash(self, entry):
+        return hash((entry.get("directory", ""), entry.get("command"), tuple(entry.get("arguments", []))))
+
+    def get_flags(self, entry):
+        if "command" in entry:
+            command = entry["command"]
+        else:
+            command = " ".join(entry.get("arguments", []))
+        directory = entry.get("directory", "")
+        flags = []
+        for flag in flags_pattern.findall(" %s" % command):
+            flag = flag.strip()
+            if flag.startswith("-I") and not os.path.isabs(flag[2:]):
+                flag = "-I%s" % os.path.normpath(os.path.join(directory, flag[2:]))
+            flags.append(self.interned.setdefault(flag, flag))
+        return self.intern(flags)
+
+    def get_filename(self, entry):
+        return normalize_path(os.path.join(entry.get("directory", ""), entry["file"]))
+
+    def load(self, filename, progress=None):
+        if filename != self.path:
+            self.commands = {}
+        self.path = filename
+        self.stat = self.get_stat(filename)
+        old_files = self.files
+        old_commands = self.commands
+        # Start over so that flags no longer used aren't kept alive
+        self.interned = {}
+        files = {}
+        commands = {}
+        folders = {}
+        with open(filename, "rb") as f:
+            for count, entry in enumerate(iter_entries(f)):
+                if progress and count % 1000 == 0:
+                    progress(count)
+                name = self.get_filename(entry)
+                command = self.get_command_hash(entry)
+                if old_commands.get(name) == command:
+                    flags = self.intern(old_files[name])
+                else:
+                    flags = self.get_flags(entry)
+                files[name] = flags
+                commands[name] = command
+                folder = os.path.dirname(name)
+                if folder not in folders:
+                    folders[folder] = ([], set())
+                merged, seen = folders[folder]
+                for flag in flags:
+                    if flag not in seen:
+                        seen.add(flag)
+                        merged.append(flag)
+        self.files = files
+        self.commands = commands
+        self.folders = dict((k, self.intern(v[0])) for k, v in folders.items())
+
+    def find_source(self, filename):
+        """
+        Returns the file in the database that is most likely to include
+        the header, the one with the same name in the same directory.
+        """
+        base = os.path.splitext(normalize_path(filename))[0]
+        for ext in SOURCE_EXTENSIONS:
+            if base + ext in self.files:
+                return base + ext
+        return None
+
+    def get_opts(self, filename):
+        """
+        Returns the flags of the file, or None if neither the file nor
+        its directory is in the database.
+        """
+        name = normalize_path(filename)
+        if name in self.files:
+            return self.files[name]
+        return self.folders.get(os.path.dirname(name))
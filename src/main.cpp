@@ -24,9 +24,12 @@ freely, subject to the following restrictions:
 #include <stdio.h>
 #include <string>
 #include <string.h>
+#include <ctype.h>
 #include <vector>
 #include <map>
+#include <set>
 #include <algorithm>
+#include <new>
 
 #if _WIN32
     #if _MSC_VER
@@ -42,22 +45,116 @@ freely, subject to the following restrictions:
     #define MINGWSUPPORT
 #endif
 
-bool operator<(const CXCursor &c1, const CXCursor &c2)
-{
-    CXString s1       = clang_getCursorUSR(c1);
-    CXString s2       = clang_getCursorUSR(c2);
-    const char *cstr1 = clang_getCString(s1);
-    const char *cstr2 = clang_getCString(s2);
-    bool ret          = strcmp(cstr1, cstr2) < 0;
-    clang_disposeString(s1);
-    clang_disposeString(s2);
-    return ret;
-}
-
 class Entry;
 typedef std::vector<CXCursor>          CursorList;
 typedef std::vector<Entry*>            EntryList;
-typedef std::map<CXCursor, CursorList> CategoryContainer;
+
+// FNV-1a
+unsigned int hash_string(const char *str)
+{
+    unsigned int h = 2166136261u;
+    while (*str)
+    {
+        h ^= (unsigned char) *str++;
+        h *= 16777619u;
+    }
+    return h;
+}
+
+// The ObjC categories of each class in a hash table keyed by the USR of
+// the class. Looking up a class only needs its USR once, where a map
+// ordered by cursor had to get the USRs of both cursors in every
+// comparison.
+class CategoryContainer
+{
+public:
+    CategoryContainer()
+    : mBuckets(16), mCount(0)
+    {
+    }
+    void clear()
+    {
+        mBuckets.clear();
+        mBuckets.resize(16);
+        mCount = 0;
+    }
+    void add(CXCursor cls, CXCursor category)
+    {
+        std::string usr;
+        unsigned int hash = getUSR(cls, usr);
+        Category *c = find(hash, usr);
+        if (!c)
+        {
+            if (mCount >= mBuckets.size())
+                rehash(mBuckets.size()*2);
+            Bucket &bucket = mBuckets[hash & (mBuckets.size()-1)];
+            bucket.push_back(Category());
+            c = &bucket.back();
+            c->hash = hash;
+            c->usr = usr;
+            mCount++;
+        }
+        c->cursors.push_back(category);
+    }
+    // Returns the categories of the class or NULL if it doesn't have any
+    CursorList* find(CXCursor cls)
+    {
+        if (mCount == 0)
+            return NULL;
+        std::string usr;
+        unsigned int hash = getUSR(cls, usr);
+        Category *c = find(hash, usr);
+        return c ? &c->cursors : NULL;
+    }
+private:
+    class Category
+    {
+    public:
+        unsigned int hash;
+        std::string  usr;
+        CursorList   cursors;
+    };
+    typedef std::vector<Category> Bucket;
+
+    unsigned int getUSR(CXCursor cursor, std::string &usr)
+    {
+        CXString s = clang_getCursorUSR(cursor);
+        const char *str = clang_getCString(s);
+        if (str)
+            usr = str;
+        clang_disposeString(s);
+        return hash_string(usr.c_str());
+    }
+    Category* find(unsigned int hash, const std::string &usr)
+    {
+        Bucket &bucket = mBuckets[hash & (mBuckets.size()-1)];
+        for (Bucket::iterator i = bucket.begin(); i != bucket.end(); ++i)
+        {
+            if ((*i).hash == hash && (*i).usr == usr)
+                return &(*i);
+        }
+        return NULL;
+    }
+    void rehash(size_t size)
+    {
+        std::vector<Bucket> buckets(size);
+        for (std::vector<Bucket>::iterator i = mBuckets.begin(); i != mBuckets.end(); ++i)
+        {
+            for (Bucket::iterator j = (*i).begin(); j != (*i).end(); ++j)
+            {
+                Bucket &bucket = buckets[(*j).hash & (size-1)];
+                bucket.push_back(Category());
+                bucket.back().hash = (*j).hash;
+                bucket.back().usr.swap((*j).usr);
+                bucket.back().cursors.swap((*j).cursors);
+            }
+        }
+        mBuckets.swap(buckets);
+    }
+
+    std::vector<Bucket> mBuckets;
+    size_t              mCount;
+};
 
 
 void dump(CXCursor cursor)
@@ -107,13 +204,7 @@ CXChildVisitResult get_objc_categories_visitor(CXCursor cursor, CXCursor parent,
             if (!clang_Cursor_isNull(ref))
             {
                 CategoryContainer* cont = (CategoryContainer*) client_data;
-                CategoryContainer::iterator i = cont->find(ref);
-                if (i == cont->end())
-                {
-                    CursorList add;
-                    (*cont)[ref] = add;
-                }
-                (*cont)[ref].push_back(cursor);
+                cont->add(ref, cursor);
             }
         }
     }
@@ -351,31 +442,28 @@ std::string collapse(std::string before, char startT, char endT, char extraT='\0
     return before;
 }
 
+class StringArena;
+
 class Entry
 {
 public:
     Entry(CXCursor c, std::string &disp, std::string &ins, CX_CXXAccessSpecifier a=CX_CXXPublic, bool base=false)
-    : cursor(c), access(a), isStatic(false), isBaseClass(base)
+    : cursor(c), access(a), isStatic(false), isBaseClass(base), arena(NULL)
     {
         display = new char[disp.length()+1];
         memcpy(display, disp.c_str(), disp.length()+1);
         insert = new char[ins.length()+1];
         memcpy(insert, ins.c_str(), ins.length()+1);
-
-        if (!clang_Cursor_isNull(c))
-        {
-            CXCursorKind ck = clang_getCursorKind(c);
-            switch (ck)
-            {
-                case CXCursor_CXXMethod:           isStatic = clang_CXXMethod_isStatic(c); break;
-                case CXCursor_VarDecl:             isStatic = true;                        break;
-                case CXCursor_ObjCClassMethodDecl: isStatic = true;                        break;
-                default:                           isStatic = false;                       break;
-            }
-        }
+        setStatic();
+    }
+    // An entry whose strings are stored in the arena it's allocated in
+    Entry(CXCursor c, const char *disp, const char *ins, CX_CXXAccessSpecifier a, bool base, StringArena *ar)
+    : cursor(c), insert((char*) ins), display((char*) disp), access(a), isStatic(false), isBaseClass(base), arena(ar)
+    {
+        setStatic();
     }
     Entry(const Entry& other)
-    : cursor(other.cursor), access(other.access), isStatic(other.isStatic), isBaseClass(other.isBaseClass)
+    : cursor(other.cursor), access(other.access), isStatic(other.isStatic), isBaseClass(other.isBaseClass), arena(NULL)
     {
         display = new char[strlen(other.display)+1];
         memcpy(display, other.display, strlen(other.display)+1);
@@ -384,8 +472,11 @@ public:
     }
     ~Entry()
     {
-        delete[] display;
-        delete[] insert;
+        if (!arena)
+        {
+            delete[] display;
+            delete[] insert;
+        }
     }
     bool operator==(const Entry& other) const
     {
@@ -397,16 +488,165 @@ public:
     CX_CXXAccessSpecifier access;
     bool                  isStatic;
     bool                  isBaseClass;
+    // The arena the entry and its strings are in, or NULL if it's on
+    // the heap. Must stay after the fields read through ctypes.
+    StringArena *         arena;
+
+private:
+    void setStatic()
+    {
+        CXCursor c = cursor;
+        if (!clang_Cursor_isNull(c))
+        {
+            CXCursorKind ck = clang_getCursorKind(c);
+            switch (ck)
+            {
+                case CXCursor_CXXMethod:           isStatic = clang_CXXMethod_isStatic(c); break;
+                case CXCursor_VarDecl:             isStatic = true;                        break;
+                case CXCursor_ObjCClassMethodDecl: isStatic = true;                        break;
+                default:                           isStatic = false;                       break;
+            }
+        }
+    }
+};
+
+// Stores the entries of a cache and their strings in large chunks rather
+// than allocating each of them on its own, so that building a cache
+// doesn't need hundreds of thousands of small allocations, and freeing
+// it only needs one per chunk. Identical strings are only stored once.
+//
+// Memory of entries that are released isn't reused, so once more of the
+// arena is released than is in use the owner should move the entries
+// still in use to a new arena.
+class StringArena
+{
+public:
+    StringArena()
+    : mPos(0), mEnd(0), mStringCount(0), mLive(0), mReleased(0)
+    {
+        mStrings.resize(1024);
+    }
+    ~StringArena()
+    {
+        // The entries in the arena have nothing to destruct
+        for (std::vector<char*>::iterator i = mChunks.begin(); i != mChunks.end(); ++i)
+        {
+            delete[] *i;
+        }
+    }
+
+    const char* intern(const char *str)
+    {
+        unsigned int hash = hash_string(str);
+        size_t mask = mStrings.size()-1;
+        size_t i = hash & mask;
+        for (; mStrings[i].second; i = (i+1) & mask)
+        {
+            if (mStrings[i].first == hash && !strcmp(mStrings[i].second, str))
+                return mStrings[i].second;
+        }
+        size_t length = strlen(str)+1;
+        char *s = (char*) allocate(length, 1);
+        memcpy(s, str, length);
+        mStrings[i] = InternedString(hash, s);
+        if (++mStringCount*2 > mStrings.size())
+            rehash();
+        return s;
+    }
+
+    Entry* newEntry(CXCursor cursor, const std::string &disp, const std::string &ins, CX_CXXAccessSpecifier access, bool isBaseClass)
+    {
+        void *mem = allocate(sizeof(Entry), sizeof(void*));
+        mLive++;
+        return new (mem) Entry(cursor, intern(disp.c_str()), intern(ins.c_str()), access, isBaseClass, this);
+    }
+
+    // Copies the entry into this arena, sharing its strings if they're
+    // already here
+    Entry* copyEntry(const Entry &other)
+    {
+        const char *disp = other.arena == this ? other.display : intern(other.display);
+        const char *ins = other.arena == this ? other.insert : intern(other.insert);
+        void *mem = allocate(sizeof(Entry), sizeof(void*));
+        mLive++;
+        Entry *e = new (mem) Entry(other.cursor, disp, ins, other.access, other.isBaseClass, this);
+        e->isStatic = other.isStatic;
+        return e;
+    }
+
+    void release(Entry *e)
+    {
+        e->~Entry();
+        mLive--;
+        mReleased++;
+    }
+
+    bool isFragmented() const
+    {
+        return mReleased > 1024 && mReleased > mLive;
+    }
+private:
+    typedef std::pair<unsigned int, const char*> InternedString;
+    enum { CHUNK_SIZE = 256*1024 };
+
+    void* allocate(size_t size, size_t alignment)
+    {
+        mPos = (mPos + alignment-1) & ~(alignment-1);
+        if (mPos + size > mEnd)
+        {
+            size_t chunk = std::max((size_t) CHUNK_SIZE, size);
+            mChunks.push_back(new char[chunk]);
+            mPos = 0;
+            mEnd = chunk;
+        }
+        void *ret = mChunks.back() + mPos;
+        mPos += size;
+        return ret;
+    }
+    void rehash()
+    {
+        std::vector<InternedString> strings(mStrings.size()*2);
+        size_t mask = strings.size()-1;
+        for (std::vector<InternedString>::iterator i = mStrings.begin(); i != mStrings.end(); ++i)
+        {
+            if (!(*i).second)
+                continue;
+            size_t pos = (*i).first & mask;
+            while (strings[pos].second)
+                pos = (pos+1) & mask;
+            strings[pos] = *i;
+        }
+        mStrings.swap(strings);
+    }
+
+    std::vector<char*>          mChunks;
+    size_t                      mPos;
+    size_t                      mEnd;
+    std::vector<InternedString> mStrings;
+    size_t                      mStringCount;
+    size_t                      mLive;
+    size_t                      mReleased;
 };
 
+void destroy(Entry *e)
+{
+    if (!e)
+        return;
+    if (e->arena)
+        e->arena->release(e);
+    else
+        delete e;
+}
+
 
-void trim(EntryList& mEntries)
+void trim(EntryList& mEntries, bool deleteEntries=true)
 {
     EntryList::iterator i = mEntries.begin();
     // Trim nameless completions
     while (i != mEntries.end() && (*i)->display[0] == '\t')
     {
-        delete *i;
+        if (deleteEntries)
+            destroy(*i);
         mEntries.erase(i);
         i = mEntries.begin();
     }
@@ -428,7 +668,8 @@ void trim(EntryList& mEntries)
             bool begin = del == mEntries.begin();
             if (!begin)
                 i = del-1;
-            delete *del;
+            if (deleteEntries)
+                destroy(*del);
             mEntries.erase(del);
             if (begin)
             {
@@ -463,6 +704,250 @@ public:
     }
 };
 
+inline char fold(char c)
+{
+    return (char) tolower((unsigned char) c);
+}
+
+class EntryFoldedCompare
+{
+public:
+    bool operator()(const Entry *a, const Entry *b) const
+    {
+        const char *s1 = a->display;
+        const char *s2 = b->display;
+        while (*s1 && fold(*s1) == fold(*s2))
+        {
+            s1++;
+            s2++;
+        }
+        if (fold(*s1) != fold(*s2))
+            return fold(*s1) < fold(*s2);
+        return strcmp(a->display, b->display) < 0;
+    }
+};
+
+// A compacted trie over the displays of a sorted list of entries. Since
+// the list is sorted, the entries starting with any given prefix are a
+// range of it, and each node of the trie holds the range of the entries
+// below it. The trie is built from the longest common prefixes of
+// neighbouring entries, so it costs a single pass over the list, and a
+// prefix is looked up by walking at most one node per character.
+//
+// With fold set, characters are compared case insensitively, in which
+// case the list must be sorted with EntryFoldedCompare.
+class PrefixIndex
+{
+public:
+    PrefixIndex(bool fold=false)
+    : mEntries(NULL), mFold(fold)
+    {
+    }
+
+    void build(const EntryList &entries)
+    {
+        mEntries = &entries;
+        mNodes.clear();
+        mNodes.push_back(Node(0, 0));
+        std::vector<int> stack;
+        stack.push_back(0);
+        for (size_t i = 0; i < entries.size(); i++)
+        {
+            unsigned int lcp = i ? common(entries[i-1]->display, entries[i]->display) : 0;
+            while (mNodes[stack.back()].depth > lcp)
+            {
+                int node = stack.back();
+                stack.pop_back();
+                mNodes[node].hi = (unsigned int) i;
+                if (mNodes[stack.back()].depth < lcp)
+                {
+                    // The entry branches off in the middle of the edge
+                    stack.push_back(addNode(lcp, mNodes[node].lo));
+                }
+                addChild(stack.back(), node);
+            }
+            unsigned int length = (unsigned int) strlen(entries[i]->display);
+            if (mNodes[stack.back()].depth < length)
+                stack.push_back(addNode(length, (unsigned int) i));
+        }
+        while (stack.size() > 1)
+        {
+            int node = stack.back();
+            stack.pop_back();
+            mNodes[node].hi = (unsigned int) entries.size();
+            addChild(stack.back(), node);
+        }
+        mNodes[0].hi = (unsigned int) entries.size();
+    }
+
+    // Sets the range of the entries starting with prefix and returns
+    // false if there aren't any
+    bool find(const char *prefix, size_t &lo, size_t &hi) const
+    {
+        lo = hi = 0;
+        if (!mEntries || mEntries->empty())
+            return false;
+        const Node *node = &mNodes[0];
+        unsigned int pos = 0;
+        while (prefix[pos])
+        {
+            if (pos == node->depth)
+            {
+                // Pick the child that continues with the next character
+                int child = node->firstChild;
+                while (child != -1 && !equal(display(mNodes[child]), pos, prefix[pos]))
+                    child = mNodes[child].nextSibling;
+                if (child == -1)
+                    return false;
+                node = &mNodes[child];
+            }
+            const char *str = display(*node);
+            for (; pos < node->depth && prefix[pos]; pos++)
+            {
+                if (!equal(str, pos, prefix[pos]))
+                    return false;
+            }
+        }
+        lo = node->lo;
+        hi = node->hi;
+        return true;
+    }
+
+    size_t count(const char *prefix) const
+    {
+        size_t lo, hi;
+        find(prefix, lo, hi);
+        return hi-lo;
+    }
+private:
+    class Node
+    {
+    public:
+        Node(unsigned int d, unsigned int l)
+        : depth(d), lo(l), hi(l), firstChild(-1), lastChild(-1), nextSibling(-1)
+        {
+        }
+        unsigned int depth;       // Length of the prefix shared by the range
+        unsigned int lo;
+        unsigned int hi;
+        int          firstChild;
+        int          lastChild;
+        int          nextSibling;
+    };
+
+    int addNode(unsigned int depth, unsigned int lo)
+    {
+        mNodes.push_back(Node(depth, lo));
+        return (int) mNodes.size()-1;
+    }
+    void addChild(int parent, int child)
+    {
+        // Children are added in order, so they stay sorted
+        if (mNodes[parent].lastChild == -1)
+            mNodes[parent].firstChild = child;
+        else
+            mNodes[mNodes[parent].lastChild].nextSibling = child;
+        mNodes[parent].lastChild = child;
+    }
+    const char *display(const Node &node) const
+    {
+        return (*mEntries)[node.lo]->display;
+    }
+    bool equal(const char *str, unsigned int pos, char c) const
+    {
+        return mFold ? fold(str[pos]) == fold(c) : str[pos] == c;
+    }
+    unsigned int common(const char *a, const char *b) const
+    {
+        unsigned int i = 0;
+        while (a[i] && equal(b, i, a[i]))
+            i++;
+        return i;
+    }
+
+    const EntryList*  mEntries;
+    std::vector<Node> mNodes;
+    bool              mFold;
+};
+
+// Scores how well the name of an entry matches a query whose characters
+// have to appear in the name in the same order, but not necessarily next
+// to each other. Characters matched at the start of the name, at the
+// start of a word in a camelCase or underscore separated name, or right
+// after the previous match score higher, and gaps between the matches
+// cost a little. Returns false if the query doesn't match at all.
+class FuzzyMatcher
+{
+public:
+    FuzzyMatcher(const char *query)
+    : mQuery(query), mLength((unsigned int) strlen(query))
+    {
+    }
+    bool match(const char *name, int &score) const
+    {
+        unsigned int end = 0;
+        while (isalnum((unsigned char) name[end]) || name[end] == '_')
+            end++;
+        if (end < mLength)
+            return false;
+        score = 0;
+        unsigned int pos = 0;
+        int last = -1;
+        for (unsigned int q = 0; q < mLength; q++)
+        {
+            while (pos < end && fold(name[pos]) != fold(mQuery[q]))
+                pos++;
+            if (pos == end)
+                return false;
+            score += 1;
+            if (name[pos] == mQuery[q])
+                score += 1;
+            if (pos == 0)
+                score += 8;
+            else if (isBoundary(name, pos))
+                score += 6;
+            if (last != -1)
+            {
+                if ((int) pos == last+1)
+                    score += 4;
+                else
+                    score -= std::min((int) pos-last-1, 3);
+            }
+            last = (int) pos;
+            pos++;
+        }
+        // Prefer the shorter of otherwise equal names
+        score -= (int) (end-mLength)/4;
+        return true;
+    }
+private:
+    static bool isBoundary(const char *name, unsigned int pos)
+    {
+        char prev = name[pos-1];
+        char c = name[pos];
+        return prev == '_' ||
+               (islower((unsigned char) prev) && isupper((unsigned char) c)) ||
+               (!isdigit((unsigned char) prev) && isdigit((unsigned char) c));
+    }
+
+    const char*  mQuery;
+    unsigned int mLength;
+};
+
+typedef std::pair<int, Entry*> ScoredEntry;
+
+// Orders the best match first
+class ScoredEntryCompare
+{
+public:
+    bool operator()(const ScoredEntry &a, const ScoredEntry &b) const
+    {
+        if (a.first != b.first)
+            return a.first > b.first;
+        return strcmp(a.second->display, b.second->display) < 0;
+    }
+};
+
 class CacheCompletionResults
 {
 public:
@@ -485,7 +970,7 @@ public:
         {
             for (unsigned int i = 0; i < length; i++)
             {
-                delete entries[i];
+                destroy(entries[i]);
             }
         }
         delete[] entries;
@@ -497,6 +982,148 @@ public:
     bool         deleteEntries;
 };
 
+// A completion candidate found while building a partition. Candidates
+// without a name are recorded too so that the visit can be replayed
+// exactly the next time the partition is updated.
+class Slot
+{
+public:
+    Slot(CXCursor cursor, CXFile *file=NULL)
+    : entry(NULL), kind(clang_getCursorKind(cursor))
+    {
+        clang_getExpansionLocation(clang_getCursorLocation(cursor), file, &line, &column, NULL);
+    }
+    bool matches(const Slot& other) const
+    {
+        return kind == other.kind && line == other.line && column == other.column;
+    }
+    Entry*       entry;
+    CXCursorKind kind;
+    unsigned int line;
+    unsigned int column;
+};
+typedef std::vector<Slot> SlotList;
+
+// The entries of the cache coming from a single source file
+class Partition
+{
+public:
+    ~Partition()
+    {
+        for (SlotList::iterator i = slots.begin(); i != slots.end(); ++i)
+        {
+            destroy((*i).entry);
+        }
+    }
+    // Drops the entries without releasing them one by one, for when
+    // the arena they were created in is about to be freed as a whole
+    void abandon()
+    {
+        slots.clear();
+        entries.clear();
+    }
+    SlotList  slots;    // Every candidate in the order it was visited
+    EntryList entries;  // The named entries sorted by display
+    // Other files that some of the entries come from, such as a file
+    // included inside an extern "C" block of this one. The partition
+    // can't be reused once any of them has changed.
+    std::set<std::string> files;
+};
+
+// Creates the entries of a partition. When given the same partition
+// from a previous translation unit, entries are taken over
+// from there for as long as the visited cursors match what was visited
+// last time, so that their completion strings don't have to be
+// recreated. The cursors of reused entries are refreshed since the old
+// ones are invalid after a reparse.
+class PartitionBuilder
+{
+public:
+    PartitionBuilder(Partition *p, Partition *old, StringArena *arena, CXFile file)
+    : mPartition(p), mOld(old), mArena(arena), mPos(0), mReplaying(old != NULL), mFile(file), mLastFile(file)
+    {
+    }
+    ~PartitionBuilder()
+    {
+        if (!mOld)
+            return;
+        // Whatever wasn't reused is gone
+        SlotList &slots = mOld->slots;
+        for (size_t i = mPos; i < slots.size(); i++)
+        {
+            destroy(slots[i].entry);
+        }
+        slots.clear();
+        delete mOld;
+    }
+
+    // Returns the entry for the cursor or NULL if it doesn't have a name
+    Entry* add(CXCursor cursor, CX_CXXAccessSpecifier access, bool isBaseClass)
+    {
+        CXFile file = NULL;
+        Slot slot(cursor, &file);
+        if (file != mLastFile)
+        {
+            mLastFile = file;
+            if (file && file != mFile)
+            {
+                CXString s = clang_getFileName(file);
+                const char *str = clang_getCString(s);
+                if (str)
+                    mPartition->files.insert(str);
+                clang_disposeString(s);
+            }
+        }
+        if (mReplaying)
+        {
+            if (mPos < mOld->slots.size() && mOld->slots[mPos].matches(slot))
+            {
+                Entry *e = mOld->slots[mPos].entry;
+                if (!e || (e->access == access && e->isBaseClass == isBaseClass))
+                {
+                    mPos++;
+                    if (e)
+                        e->cursor = cursor;
+                    slot.entry = e;
+                    mPartition->slots.push_back(slot);
+                    return e;
+                }
+            }
+            // Something changed, so the rest is created from scratch
+            mReplaying = false;
+        }
+        std::string ins;
+        std::string disp;
+        parse_res(ins, disp, cursor);
+        if (ins.length() != 0)
+            slot.entry = mArena->newEntry(cursor, disp, ins, access, isBaseClass);
+        mPartition->slots.push_back(slot);
+        return slot.entry;
+    }
+
+    // Sorts the entries once the partition has been visited
+    void finish()
+    {
+        if (mReplaying && mPos == mOld->slots.size())
+        {
+            // Same entries in the same order, so they're already sorted
+            mPartition->entries.swap(mOld->entries);
+        }
+        else
+        {
+            std::sort(mPartition->entries.begin(), mPartition->entries.end(), EntryCompare());
+        }
+    }
+private:
+    Partition*   mPartition;
+    Partition*   mOld;
+    StringArena* mArena;
+    size_t       mPos;
+    bool         mReplaying;
+    CXFile       mFile;      // The file of the partition
+    CXFile       mLastFile;
+};
+
 CXCursor get_using_cursor(CXCursor cursor, CXCursorKind ck)
 {
     CursorList cur;
@@ -521,17 +1148,30 @@ CXCursor get_using_cursor(CXCursor cursor, CXCursorKind ck)
 class CompletionVisitorData
 {
 public:
-    CompletionVisitorData(EntryList& e, CX_CXXAccessSpecifier a=CX_CXXPrivate, bool base=false)
-    : entries(e), access(a), isBaseClass(base)
+    CompletionVisitorData(EntryList& e, CX_CXXAccessSpecifier a=CX_CXXPrivate, bool base=false, PartitionBuilder *b=NULL)
+    : entries(e), access(a), isBaseClass(base), builder(b)
     {
     }
 
     void visit_children(CXCursor cursor)
     {
         clang_visitChildren(cursor, get_completion_children, this);
+        visit_anonymous_structs();
+    }
+
+    // Visits a single child of parent, for when the children are
+    // visited one by one rather than through visit_children
+    void visit(CXCursor cursor, CXCursor parent)
+    {
+        if (get_completion_children(cursor, parent, this) == CXChildVisit_Recurse)
+            clang_visitChildren(cursor, get_completion_children, this);
+    }
+
+    void visit_anonymous_structs()
+    {
         for (CursorList::iterator i = mAnonymousStructs.begin(); i < mAnonymousStructs.end(); i++)
         {
-            CompletionVisitorData d(entries, access, isBaseClass);
+            CompletionVisitorData d(entries, access, isBaseClass, builder);
             d.visit_children(*i);
         }
     }
@@ -580,11 +1220,21 @@ public:
             case CXCursor_NamespaceAlias:
             case CXCursor_MacroDefinition:
             {
-                std::string ins;
-                std::string disp;
-                parse_res(ins, disp, cursor);
-                if (ins.length() != 0)
-                    entries.push_back(new Entry(cursor, disp, ins, access, isBaseClass));
+                Entry *e = NULL;
+                if (builder)
+                {
+                    e = builder->add(cursor, access, isBaseClass);
+                }
+                else
+                {
+                    std::string ins;
+                    std::string disp;
+                    parse_res(ins, disp, cursor);
+                    if (ins.length() != 0)
+                        e = new Entry(cursor, disp, ins, access, isBaseClass);
+                }
+                if (e)
+                    entries.push_back(e);
                 else if (ck == CXCursor_StructDecl)
                 {
                     // Might be an anonymous struct whose children we need to add later
@@ -621,6 +1271,7 @@ public:
     EntryList &           entries;
     CX_CXXAccessSpecifier access;
     bool                  isBaseClass;
+    PartitionBuilder *    builder;
 
 private:
     CursorList            mAnonymousStructs;
@@ -645,7 +1296,7 @@ private:
                 if (!clang_Cursor_isNull(ref) && !clang_isInvalid(clang_getCursorKind(ref)) && !clang_equalCursors(ref, parent))
                 {
                     data->mParents.push_back(ref);
-                    CompletionVisitorData d(data->entries, ck == CXCursor_CXXBaseSpecifier ? CX_CXXPrivate : CX_CXXProtected, true);
+                    CompletionVisitorData d(data->entries, ck == CXCursor_CXXBaseSpecifier ? CX_CXXPrivate : CX_CXXProtected, true, data->builder);
                     if (clang_getCursorKind(ref) == CXCursor_StructDecl)
                     {
                         d.access = CX_CXXPublic;
@@ -969,95 +1620,322 @@ private:
 };
 
 
-class Cache
+typedef std::map<std::string, Partition*> PartitionMap;
+typedef std::map<std::string, EntryList>  MemberTableMap;
+
+// Sorts the top level children of a translation unit into partitions by
+// the file they are in. Partitions of files that haven't changed since
+// the last update are replayed from their old slots.
+class CacheUpdater
 {
 public:
-    Cache(CXCursor base)
-    : mBaseCursor(base)
+    CacheUpdater(PartitionMap &partitions, PartitionMap &old, std::set<std::string> &changed, bool all, StringArena *arena)
+    : mPartitions(partitions), mOld(old), mChanged(changed), mAll(all), mArena(arena), mLast(NULL), mLastFile(NULL)
+    {
+    }
+    ~CacheUpdater()
+    {
+        for (std::map<std::string, Builder*>::iterator i = mBuilders.begin(); i != mBuilders.end(); ++i)
+        {
+            delete (*i).second;
+        }
+    }
+
+    void execute(CXCursor base)
     {
-        CompletionVisitorData d(mEntries, CX_CXXPublic);
-        d.visit_children(base);
+        clang_visitChildren(base, &CacheUpdater::visitor, this);
+        for (std::map<std::string, Builder*>::iterator i = mBuilders.begin(); i != mBuilders.end(); ++i)
+        {
+            Builder *b = (*i).second;
+            b->data.visit_anonymous_structs();
+            b->builder.finish();
+        }
+    }
 
-        std::sort(mEntries.begin(), mEntries.end(), EntryCompare());
-        for (EntryList::iterator i = mEntries.begin(); i != mEntries.end(); ++i)
+private:
+    class Builder
+    {
+    public:
+        Builder(Partition *p, Partition *old, StringArena *arena, CXFile file)
+        : builder(p, old, arena, file), data(p->entries, CX_CXXPublic, false, &builder)
         {
-            Entry *e = *i;
-            CXCursorKind ck = clang_getCursorKind(e->cursor);
-            if (ck == CXCursor_Namespace)
+        }
+        PartitionBuilder      builder;
+        CompletionVisitorData data;
+    };
+
+    Builder* getBuilder(CXFile file)
+    {
+        std::string name;
+        if (file)
+        {
+            CXString s = clang_getFileName(file);
+            const char *str = clang_getCString(s);
+            if (str)
+                name = str;
+            clang_disposeString(s);
+        }
+        std::map<std::string, Builder*>::iterator i = mBuilders.find(name);
+        if (i != mBuilders.end())
+            return (*i).second;
+
+        Partition *old = NULL;
+        PartitionMap::iterator pos = mOld.find(name);
+        if (pos != mOld.end())
+        {
+            old = (*pos).second;
+            mOld.erase(pos);
+            if (mAll || isChanged(name) || isChanged(old->files))
             {
-                mNamespaces.push_back(new Entry(*e));
+                delete old;
+                old = NULL;
             }
         }
-        trim(mEntries);
-        clang_visitChildren(base, get_objc_categories_visitor, &mObjCCategories);
+        Partition *p = new Partition();
+        mPartitions[name] = p;
+        Builder *b = new Builder(p, old, mArena, file);
+        mBuilders[name] = b;
+        return b;
     }
-    ~Cache()
+
+    bool isChanged(const std::string &name) const
     {
-        for (EntryList::iterator i = mEntries.begin(); i != mEntries.end(); ++i)
+        return mChanged.find(name) != mChanged.end();
+    }
+    bool isChanged(const std::set<std::string> &names) const
+    {
+        for (std::set<std::string>::const_iterator i = names.begin(); i != names.end(); ++i)
         {
-            delete *i;
+            if (isChanged(*i))
+                return true;
         }
-        mEntries.clear();
-        for (EntryList::iterator i = mNamespaces.begin(); i != mNamespaces.end(); ++i)
+        return false;
+    }
+
+    static CXChildVisitResult visitor(CXCursor cursor, CXCursor parent, CXClientData client_data)
+    {
+        if (clang_Cursor_isNull(cursor))
+            return CXChildVisit_Break;
+        CacheUpdater *u = (CacheUpdater*) client_data;
+        CXFile file;
+        clang_getExpansionLocation(clang_getCursorLocation(cursor), &file, NULL, NULL, NULL);
+        if (!u->mLast || file != u->mLastFile)
         {
-            delete *i;
+            u->mLast = u->getBuilder(file);
+            u->mLastFile = file;
         }
-        mNamespaces.clear();
+        u->mLast->data.visit(cursor, parent);
+        return CXChildVisit_Continue;
+    }
+
+    PartitionMap&                    mPartitions;
+    PartitionMap&                    mOld;
+    std::set<std::string>&           mChanged;
+    bool                             mAll;
+    StringArena*                     mArena;
+    std::map<std::string, Builder*>  mBuilders;
+    Builder*                         mLast;
+    CXFile                           mLastFile;
+};
+
+bool is_member_kind(CXCursorKind ck)
+{
+    switch (ck)
+    {
+        default: return false;
+        case CXCursor_CXXMethod:
+        case CXCursor_NotImplemented:
+        case CXCursor_FieldDecl:
+        case CXCursor_ObjCPropertyDecl:
+        case CXCursor_ObjCClassMethodDecl:
+        case CXCursor_ObjCInstanceMethodDecl:
+        case CXCursor_ObjCIvarDecl:
+        case CXCursor_FunctionTemplate:
+            return true;
     }
-    bool isMemberKind(CXCursorKind ck)
+}
+
+// clang's own code completion only needs the translation unit, so it
+// doesn't have to wait for a cache to be built
+CacheCompletionResults* clang_complete(CXTranslationUnit tu, const char *filename, unsigned int row, unsigned int col, CXUnsavedFile* unsaved, unsigned int usLength, bool memberCompletion)
+{
+    CXCodeCompleteResults* res =  clang_codeCompleteAt(tu, filename, row, col, unsaved, usLength, CXCodeComplete_IncludeMacros|CXCodeComplete_IncludeCodePatterns);
+    if (!res)
+        return NULL;
+    clang_sortCodeCompletionResults(res->Results, res->NumResults);
+    // TODO: binary search to find the range
+    int start = 0;
+    int end = res->NumResults;
+    EntryList entries;
+    CXCursor tmp = clang_getNullCursor();
+
+    while (start < end)
     {
-        switch (ck)
+        if (clang_getCompletionAvailability(res->Results[start].CompletionString) == CXAvailability_NotAccessible ||
+            (memberCompletion && !is_member_kind(res->Results[start].CursorKind)))
         {
-            default: return false;
-            case CXCursor_CXXMethod:
-            case CXCursor_NotImplemented:
-            case CXCursor_FieldDecl:
-            case CXCursor_ObjCPropertyDecl:
-            case CXCursor_ObjCClassMethodDecl:
-            case CXCursor_ObjCInstanceMethodDecl:
-            case CXCursor_ObjCIvarDecl:
-            case CXCursor_FunctionTemplate:
-                return true;
+            start++;
+            continue;
         }
+
+        std::string insertion;
+        std::string representation;
+        parse_res(insertion, representation, res->Results[start].CursorKind, res->Results[start].CompletionString);
+        if (insertion.length() != 0)
+            entries.push_back(new Entry(tmp, representation, insertion));
+        start++;
     }
-    CacheCompletionResults* clangComplete(const char *filename, unsigned int row, unsigned int col, CXUnsavedFile* unsaved, unsigned int usLength, bool memberCompletion)
+    clang_disposeCodeCompleteResults(res);
+    return new CacheCompletionResults(entries.begin(), entries.end(), true);
+}
+
+class Cache
+{
+public:
+    Cache(CXCursor base)
+    : mBaseCursor(base), mFoldedIndex(true), mMemberTableEntryCount(0), mArena(new StringArena())
     {
-        CXCodeCompleteResults* res =  clang_codeCompleteAt(clang_Cursor_getTranslationUnit(mBaseCursor) , filename, row, col, unsaved, usLength, CXCodeComplete_IncludeMacros|CXCodeComplete_IncludeCodePatterns);
-        if (!res)
-            return NULL;
-        clang_sortCodeCompletionResults(res->Results, res->NumResults);
-        // TODO: binary search to find the range
-        int start = 0;
-        int end = res->NumResults;
-        EntryList entries;
-        CXCursor tmp = clang_getNullCursor();
+        update(base, NULL, 0, true);
+    }
+    ~Cache()
+    {
+        // The entries of the partitions and the namespaces are all in
+        // the arena, so they go with it rather than being released one
+        // at a time. The member tables are on the heap.
+        clearPartitions(mPartitions, false);
+        mNamespaces.clear();
+        clearMemberTables();
+        delete mArena;
+    }
 
-        while (start < end)
+    // Rebuilds the cache after the translation unit has been reparsed.
+    // Only the entries from the changed files are created from scratch,
+    // the others are reused from the previous build.
+    void update(CXCursor base, const char **changed, unsigned int changedLength, bool all=false)
+    {
+        mBaseCursor = base;
+        std::set<std::string> changedFiles;
+        for (unsigned int i = 0; i < changedLength; i++)
+        {
+            changedFiles.insert(changed[i]);
+        }
+
+        PartitionMap old;
+        old.swap(mPartitions);
         {
-            if (clang_getCompletionAvailability(res->Results[start].CompletionString) == CXAvailability_NotAccessible ||
-                (memberCompletion && !isMemberKind(res->Results[start].CursorKind)))
+            CacheUpdater updater(mPartitions, old, changedFiles, all, mArena);
+            updater.execute(base);
+        }
+        // Whatever is left is from files no longer included
+        clearPartitions(old);
+        clearNamespaces();
+        if (mArena->isFragmented())
+            compact();
+
+        // Merge the sorted partitions pairwise into one sorted list
+        mEntries.clear();
+        std::vector<size_t> bounds;
+        bounds.push_back(0);
+        for (PartitionMap::iterator i = mPartitions.begin(); i != mPartitions.end(); ++i)
+        {
+            EntryList &entries = (*i).second->entries;
+            mEntries.insert(mEntries.end(), entries.begin(), entries.end());
+            bounds.push_back(mEntries.size());
+        }
+        while (bounds.size() > 2)
+        {
+            std::vector<size_t> merged;
+            size_t i = 0;
+            for (; i+2 < bounds.size(); i += 2)
             {
-                start++;
-                continue;
+                std::inplace_merge(mEntries.begin()+bounds[i], mEntries.begin()+bounds[i+1], mEntries.begin()+bounds[i+2], EntryCompare());
+                merged.push_back(bounds[i]);
             }
+            for (; i < bounds.size(); i++)
+            {
+                merged.push_back(bounds[i]);
+            }
+            bounds.swap(merged);
+        }
 
-            std::string insertion;
-            std::string representation;
-            parse_res(insertion, representation, res->Results[start].CursorKind, res->Results[start].CompletionString);
-            if (insertion.length() != 0)
-                entries.push_back(new Entry(tmp, representation, insertion));
-            start++;
+        // The cursors of the member tables are no longer valid
+        clearMemberTables();
+        for (EntryList::iterator i = mEntries.begin(); i != mEntries.end(); ++i)
+        {
+            Entry *e = *i;
+            CXCursorKind ck = clang_getCursorKind(e->cursor);
+            if (ck == CXCursor_Namespace)
+            {
+                mNamespaces.push_back(mArena->copyEntry(*e));
+            }
         }
-        clang_disposeCodeCompleteResults(res);
-        return new CacheCompletionResults(entries.begin(), entries.end(), true);
+        // The entries are owned by the partitions
+        trim(mEntries, false);
+        mIndex.build(mEntries);
+        // Built again the next time a case insensitive query needs it
+        mFoldedEntries.clear();
+        mFoldedIndex.build(mFoldedEntries);
+        mObjCCategories.clear();
+        clang_visitChildren(base, get_objc_categories_visitor, &mObjCCategories);
+    }
+    CacheCompletionResults* clangComplete(const char *filename, unsigned int row, unsigned int col, CXUnsavedFile* unsaved, unsigned int usLength, bool memberCompletion)
+    {
+        return clang_complete(clang_Cursor_getTranslationUnit(mBaseCursor), filename, row, col, unsaved, usLength, memberCompletion);
     }
 
-    CacheCompletionResults* complete(const char *prefix)
+    // Case insensitive queries build the folded index the first time
+    // they're made after an update, so the caller must not make them
+    // concurrently with each other
+    CacheCompletionResults* complete(const char *prefix, bool ignoreCase=false)
     {
-        EntryList::iterator start = std::lower_bound(mEntries.begin(), mEntries.end(), prefix, EntryStringCompare());
-        EntryList::iterator end = std::upper_bound(mEntries.begin(), mEntries.end(), prefix, EntryStringCompare());
+        if (ignoreCase)
+            buildFoldedIndex();
+        EntryList &entries = ignoreCase ? mFoldedEntries : mEntries;
+        size_t lo, hi;
+        (ignoreCase ? mFoldedIndex : mIndex).find(prefix, lo, hi);
+        return new CacheCompletionResults(entries.begin()+lo, entries.begin()+hi);
+    }
+
+    // Returns the k entries best matching the query, best first
+    CacheCompletionResults* completeFuzzy(const char *query, unsigned int k)
+    {
+        FuzzyMatcher matcher(query);
+        // A heap of the best matches so far with the worst on top, so
+        // that it can be replaced when a better one comes along
+        std::vector<ScoredEntry> heap;
+        ScoredEntryCompare compare;
+        int score;
+        for (EntryList::iterator i = mEntries.begin(); k && i != mEntries.end(); ++i)
+        {
+            if (!matcher.match((*i)->display, score))
+                continue;
+            ScoredEntry e(score, *i);
+            if (heap.size() < k)
+            {
+                heap.push_back(e);
+                std::push_heap(heap.begin(), heap.end(), compare);
+            }
+            else if (compare(e, heap.front()))
+            {
+                std::pop_heap(heap.begin(), heap.end(), compare);
+                heap.back() = e;
+                std::push_heap(heap.begin(), heap.end(), compare);
+            }
+        }
+        std::sort_heap(heap.begin(), heap.end(), compare);
+        EntryList entries;
+        for (std::vector<ScoredEntry>::iterator i = heap.begin(); i != heap.end(); ++i)
+        {
+            entries.push_back((*i).second);
+        }
+        return new CacheCompletionResults(entries.begin(), entries.end());
+    }
 
-        return new CacheCompletionResults(start, end);
+    unsigned int countCompletions(const char *prefix, bool ignoreCase=false)
+    {
+        if (ignoreCase)
+            buildFoldedIndex();
+        return (unsigned int) (ignoreCase ? mFoldedIndex : mIndex).count(prefix);
     }
 
     CacheCompletionResults* getNamespaceMembers(const char **ns, unsigned int nsLength)
@@ -1069,20 +1947,42 @@ public:
     }
     void addCategories(CXCursor cur, CompletionVisitorData* d)
     {
-        CategoryContainer::iterator i = mObjCCategories.find(cur);
-        if (i != mObjCCategories.end())
+        CursorList *list = mObjCCategories.find(cur);
+        if (list)
         {
-            CursorList &list = (*i).second;
-            for (CursorList::iterator pos = list.begin(); pos != list.end(); pos++)
+            for (CursorList::iterator pos = list->begin(); pos != list->end(); pos++)
             {
                 d->visit_children(*pos);
             }
         }
     }
+    // The members of a class, including those of its base classes and
+    // categories, are looked up once and then kept until the cache is
+    // updated, so that completing the same type again is just a lookup
     CacheCompletionResults* completeCursor(CXCursor cur)
     {
-        std::vector<Entry *> entries;
-        CompletionVisitorData d(entries, clang_getCursorKind(cur) == CXCursor_ClassDecl ? CX_CXXPrivate : CX_CXXPublic);
+        CXCursorKind ck = clang_getCursorKind(cur);
+        std::string key;
+        CXString s = clang_getCursorUSR(cur);
+        const char *str = clang_getCString(s);
+        if (str && str[0])
+        {
+            // The kind decides the default access of the members
+            char buf[32];
+            snprintf(buf, 32, "%d:", ck);
+            key = buf;
+            key += str;
+        }
+        clang_disposeString(s);
+        if (!key.empty())
+        {
+            MemberTableMap::iterator i = mMemberTables.find(key);
+            if (i != mMemberTables.end())
+                return new CacheCompletionResults((*i).second.begin(), (*i).second.end());
+        }
+
+        EntryList entries;
+        CompletionVisitorData d(entries, ck == CXCursor_ClassDecl ? CX_CXXPrivate : CX_CXXPublic);
         d.visit_children(cur);
         addCategories(cur, &d);
         for (CursorList::iterator i = d.mParents.begin(); i != d.mParents.end(); i++)
@@ -1091,9 +1991,15 @@ public:
         }
 
         std::sort(entries.begin(), entries.end(), EntryCompare());
-        trim(mEntries);
 
-        return new CacheCompletionResults(entries.begin(), entries.end(), true);
+        // A forward declaration shares the USR of the class but has no
+        // members, so empty tables aren't kept
+        if (key.empty() || entries.empty())
+            return new CacheCompletionResults(entries.begin(), entries.end(), true);
+        EntryList &table = mMemberTables[key];
+        table.swap(entries);
+        mMemberTableEntryCount += table.size();
+        return new CacheCompletionResults(table.begin(), table.end());
     }
     CXCursor findType(const char ** namespaces, unsigned int nsLength, const char *type)
     {
@@ -1101,18 +2007,17 @@ public:
         {
             std::string disp(type);
             disp += "\t";
-            EntryList::iterator pos = std::lower_bound(mEntries.begin(), mEntries.end(), disp.c_str(), EntryStringCompare());
-            if (pos != mEntries.end() && !strncmp((*pos)->display, disp.c_str(), disp.length()))
+            size_t lo, hi;
+            if (mIndex.find(disp.c_str(), lo, hi))
             {
-                return (*pos)->cursor;
+                return mEntries[lo]->cursor;
             }
             // see if it's a template
             disp = type;
             disp += "<";
-            pos = std::lower_bound(mEntries.begin(), mEntries.end(), disp.c_str(), EntryStringCompare());
-            if (pos != mEntries.end() && !strncmp((*pos)->display, disp.c_str(), disp.length()))
+            if (mIndex.find(disp.c_str(), lo, hi))
             {
-                return (*pos)->cursor;
+                return mEntries[lo]->cursor;
             }
 
             return clang_getNullCursor();
@@ -1127,11 +2032,89 @@ public:
     {
         return mNamespaces;
     }
+    unsigned int getEntryCount() const
+    {
+        return (unsigned int) (mEntries.size() + mNamespaces.size() + mMemberTableEntryCount);
+    }
 private:
+    void clearPartitions(PartitionMap &partitions, bool release=true)
+    {
+        for (PartitionMap::iterator i = partitions.begin(); i != partitions.end(); ++i)
+        {
+            if (!release)
+                (*i).second->abandon();
+            delete (*i).second;
+        }
+        partitions.clear();
+    }
+    // Moves the entries still in use to a new arena and frees the old
+    // one, which has more released entries in it than used ones
+    void compact()
+    {
+        StringArena *arena = new StringArena();
+        for (PartitionMap::iterator i = mPartitions.begin(); i != mPartitions.end(); ++i)
+        {
+            Partition *p = (*i).second;
+            std::map<Entry*, Entry*> moved;
+            for (SlotList::iterator j = p->slots.begin(); j != p->slots.end(); ++j)
+            {
+                if ((*j).entry)
+                {
+                    Entry *e = arena->copyEntry(*(*j).entry);
+                    moved[(*j).entry] = e;
+                    (*j).entry = e;
+                }
+            }
+            for (EntryList::iterator j = p->entries.begin(); j != p->entries.end(); ++j)
+            {
+                *j = moved[*j];
+            }
+        }
+        delete mArena;
+        mArena = arena;
+    }
+    void clearMemberTables()
+    {
+        for (MemberTableMap::iterator i = mMemberTables.begin(); i != mMemberTables.end(); ++i)
+        {
+            EntryList &table = (*i).second;
+            for (EntryList::iterator j = table.begin(); j != table.end(); ++j)
+            {
+                destroy(*j);
+            }
+        }
+        mMemberTables.clear();
+        mMemberTableEntryCount = 0;
+    }
+    void clearNamespaces()
+    {
+        for (EntryList::iterator i = mNamespaces.begin(); i != mNamespaces.end(); ++i)
+        {
+            destroy(*i);
+        }
+        mNamespaces.clear();
+    }
+
+    void buildFoldedIndex()
+    {
+        if (mFoldedEntries.size() == mEntries.size())
+            return;
+        mFoldedEntries = mEntries;
+        std::stable_sort(mFoldedEntries.begin(), mFoldedEntries.end(), EntryFoldedCompare());
+        mFoldedIndex.build(mFoldedEntries);
+    }
+
     CategoryContainer   mObjCCategories;
     CXCursor            mBaseCursor;
     EntryList           mEntries;
+    EntryList           mFoldedEntries;  // mEntries sorted case insensitively
+    PrefixIndex         mIndex;
+    PrefixIndex         mFoldedIndex;
     EntryList           mNamespaces;
+    PartitionMap        mPartitions;
+    MemberTableMap      mMemberTables;
+    size_t              mMemberTableEntryCount;
+    StringArena*        mArena;
 };
 
 void NamespaceVisitorData::execute()
@@ -1157,6 +2140,11 @@ EXPORT CacheCompletionResults* cache_clangComplete(Cache* cache, const char *fil
     return cache->clangComplete(filename, row, col, unsaved, usLength, memberCompletion);
 }
 
+EXPORT CacheCompletionResults* clangComplete(CXTranslationUnit tu, const char *filename, unsigned int row, unsigned int col, CXUnsavedFile *unsaved, unsigned int usLength, bool memberCompletion)
+{
+    return clang_complete(tu, filename, row, col, unsaved, usLength, memberCompletion);
+}
+
 EXPORT CacheCompletionResults* cache_completeCursor(Cache* cache, CXCursor cur)
 {
     return cache->completeCursor(cur);
@@ -1175,11 +2163,41 @@ EXPORT CacheCompletionResults* cache_complete_startswith(Cache* cache, const cha
 {
     return cache->complete(prefix);
 }
+
+EXPORT CacheCompletionResults* cache_complete_startswith_ignorecase(Cache* cache, const char *prefix)
+{
+    return cache->complete(prefix, true);
+}
+
+EXPORT CacheCompletionResults* cache_complete_fuzzy(Cache* cache, const char *query, unsigned int k)
+{
+    return cache->completeFuzzy(query, k);
+}
+
+EXPORT unsigned int cache_count_startswith(Cache* cache, const char *prefix)
+{
+    return cache->countCompletions(prefix);
+}
+
+EXPORT unsigned int cache_count_startswith_ignorecase(Cache* cache, const char *prefix)
+{
+    return cache->countCompletions(prefix, true);
+}
 EXPORT void cache_disposeCompletionResults(CacheCompletionResults *comp)
 {
     delete comp;
 }
 
+EXPORT unsigned int cache_getEntryCount(Cache* cache)
+{
+    return cache->getEntryCount();
+}
+
+EXPORT void cache_update(Cache* cache, CXCursor base, const char **changed, unsigned int length)
+{
+    cache->update(base, changed, length);
+}
+
 EXPORT Cache* createCache(CXCursor base)
 {
     return new Cache(base);
@@ -25,11 +25,10 @@ import os
 import subprocess
 import sublime
 import sublime_plugin
-import time
 import threading
 import traceback
 import Queue
-from common import get_setting, get_cpu_count, Worker
+from common import get_setting, Worker, POOL_ANALYZER
 
 
 def parse(l):
@@ -202,7 +201,8 @@ class Analyzer(Worker):
         self.lock = threading.Lock()
         self.diags = []
         self.line = 0
-        super(Analyzer, self).__init__()
+        self.project_files = 0
+        super(Analyzer, self).__init__(pool=POOL_ANALYZER)
 
     def clear(self):
         sublime.active_window().active_view().erase_regions("clang.analyzer")
@@ -222,11 +222,11 @@ class Analyzer(Worker):
 
     def analyze_file(self, filename):
         self.update_settings()
-        self.tasks.put((self.do_analyze_file, filename))
+        self.add_task(self.do_analyze_file, filename)
 
     def analyze_project(self, folders):
         self.update_settings()
-        self.tasks.put((self.do_analyze_project, folders))
+        self.add_task(self.do_analyze_project, folders)
 
     def display_status(self):
         if get_setting("analyzer_status_messages", True):
@@ -256,17 +256,36 @@ class Analyzer(Worker):
         self.set_status("Analyzing %s done" % filename)
 
     def do_analyze_project(self, folders):
+        files = []
         for dir in folders:
             for dirpath, dirnames, filenames in os.walk(dir):
                 for file in filenames:
                     if "." in file:
                         extension = file[file.rfind(".") + 1:]
                         if extension in self.extensions:
-                            self.tasks.put((self.do_analyze_file, "%s/%s" % (dirpath, file)))
-        if get_cpu_count() > 1:
-            while not self.tasks.empty():
-                time.sleep(0.25)
-        self.tasks.put((self.set_status, "Project analyzed"))
+                            files.append("%s/%s" % (dirpath, file))
+        if len(files) == 0:
+            self.set_status("Project analyzed")
+            return
+        # The last file to be analyzed reports that the project is done,
+        # rather than this task waiting for the others while holding on
+        # to a slot of the execution budget they need
+        self.lock.acquire()
+        self.project_files += len(files)
+        self.lock.release()
+        for filename in files:
+            self.add_task(self.do_analyze_project_file, filename)
+
+    def do_analyze_project_file(self, filename):
+        try:
+            self.do_analyze_file(filename)
+        finally:
+            self.lock.acquire()
+            self.project_files -= 1
+            done = self.project_files == 0
+            self.lock.release()
+            if done:
+                self.set_status("Project analyzed")
 
     def get_diagnostic_at_line(self, line):
         for i in range(len(self.diags)):
@@ -40,26 +40,84 @@ import threading
 import time
 from errormarkers import clear_error_marks, add_error_mark, show_error_marks, \
                          update_statusbar, erase_error_marks, clang_error_panel
-from common import get_setting, get_settings, is_supported_language, get_language, get_cpu_count, run_in_main_thread, status_message
+from common import get_setting, get_settings, is_supported_language, get_language, get_cpu_count, run_in_main_thread, status_message, \
+                   includePathCache, timerScheduler, workersReady, executionBudget, POOL_SEARCH, \
+                   PRIORITY_FOREGROUND, PRIORITY_VISIBLE, PRIORITY_BACKGROUND, PRIORITY_SEARCH
 import translationunitcache
+from compilationdatabase import normalize_path
 from parsehelp import parsehelp
 import Queue
 
 
-def warm_up_cache(view, filename=None):
+def get_view_priority(view):
+    window = sublime.active_window()
+    if window != None and window.active_view() != None and window.active_view().id() == view.id():
+        return PRIORITY_FOREGROUND
+    window = view.window()
+    if window != None:
+        for group in range(window.num_groups()):
+            v = window.active_view_in_group(group)
+            if v != None and v.id() == view.id():
+                return PRIORITY_VISIBLE
+    return PRIORITY_BACKGROUND
+
+
+def get_tu_filename(view, filename=None):
+    # Headers are served by the translation unit of
+    # a source file that includes them if there is one
     if filename == None:
         filename = view.file_name()
+    source = translationunitcache.tuCache.get_including_file(view, filename)
+    if source != None:
+        return source
+    return filename
+
+
+def get_tu_views(view):
+    """
+    Returns a view of every open file that's part of the translation
+    unit of the view, the view itself first. A header and the source
+    file whose translation unit serves it can both be modified, and the
+    translation unit has to be parsed from both buffers.
+    """
+    files = translationunitcache.tuCache.get_files(get_tu_filename(view))
+    views = [view]
+    seen = set([view.file_name()])
+    for window in sublime.windows():
+        for v in window.views():
+            name = v.file_name()
+            if name != None and name not in seen and normalize_path(name) in files:
+                seen.add(name)
+                views.append(v)
+    return views
+
+
+def get_unsaved_files(views):
+    unsaved_files = []
+    for v in views:
+        if v.is_dirty():
+            unsaved_files.append((v.file_name(), v.substr(Region(0, v.size()))))
+    return unsaved_files
+
+
+def get_versions(views):
+    return dict((v.file_name(), v.change_count()) for v in views)
+
+
+def warm_up_cache(view, filename=None, priority=None):
+    filename = get_tu_filename(view, filename)
+    if priority == None:
+        priority = get_view_priority(view)
     stat = translationunitcache.tuCache.get_status(filename)
     if stat == translationunitcache.TranslationUnitCache.STATUS_NOT_IN_CACHE:
-        translationunitcache.tuCache.add(view, filename)
+        translationunitcache.tuCache.add(view, filename, priority=priority)
     return stat
 
 
 def get_translation_unit(view, filename=None, blocking=False):
-    if filename == None:
-        filename = view.file_name()
+    filename = get_tu_filename(view, filename)
     if get_setting("warm_up_in_separate_thread", True, view) and not blocking:
-        stat = warm_up_cache(view, filename)
+        stat = warm_up_cache(view, filename, PRIORITY_FOREGROUND)
         if stat == translationunitcache.TranslationUnitCache.STATUS_NOT_IN_CACHE:
             return None
         elif stat == translationunitcache.TranslationUnitCache.STATUS_PARSING:
@@ -67,6 +125,24 @@ def get_translation_unit(view, filename=None, blocking=False):
             return None
     return translationunitcache.tuCache.get_translation_unit(filename, translationunitcache.tuCache.get_opts(view, filename), translationunitcache.tuCache.get_opts_script(view))
 
+
+def update_open_files(closing=None):
+    # Let the cache know which files are open and visible, so that
+    # it won't evict translation units that are likely to be used soon
+    openFiles = []
+    visibleFiles = []
+    for window in sublime.windows():
+        for view in window.views():
+            if view.id() != closing and view.file_name() != None:
+                openFiles.append(view.file_name())
+                openFiles.append(get_tu_filename(view))
+        for group in range(window.num_groups()):
+            view = window.active_view_in_group(group)
+            if view != None and view.id() != closing and view.file_name() != None:
+                visibleFiles.append(view.file_name())
+                visibleFiles.append(get_tu_filename(view))
+    translationunitcache.tuCache.set_open_files(openFiles, visibleFiles)
+
 navigation_stack = []
 clang_complete_enabled = True
 clang_fast_completions = True
@@ -104,7 +180,7 @@ class ClangToggleFastCompletions(sublime_plugin.TextCommand):
 
 class ClangWarmupCache(sublime_plugin.TextCommand):
     def run(self, edit):
-        stat = warm_up_cache(self.view)
+        stat = warm_up_cache(self.view, priority=PRIORITY_FOREGROUND)
         if stat == translationunitcache.TranslationUnitCache.STATUS_PARSING:
             sublime.status_message("Cache is already warming up")
         elif stat != translationunitcache.TranslationUnitCache.STATUS_NOT_IN_CACHE:
@@ -171,7 +247,7 @@ class ExtensiveSearch:
             for cpu in range(get_cpu_count()):
                 t = threading.Thread(target=self.worker)
                 t.start()
-            self.queue.put((0, "*/+", self.window.folders(), (translationunitcache.tuCache.get_opts(self.view), translationunitcache.tuCache.get_opts_script(self.view))))
+            self.queue.put((0, "*/+", self.window.folders(), (translationunitcache.tuCache.get_opts(self.view, self.view.file_name()), translationunitcache.tuCache.get_opts_script(self.view))))
 
     def __init__(self, cursor, spelling, view, window, name="", impl=True, search_re=None, file_re=None):
         self.name = name
@@ -234,14 +310,15 @@ class ExtensiveSearch:
         try:
             self.lock.acquire()
             self.status = message
-            if self.timer:
-                self.timer.cancel()
-                self.timer = None
             self.status_count += 1
             if self.status_count == 30:
+                if self.timer:
+                    self.timer.cancel()
                 self.do_message()
+            elif self.timer:
+                self.timer.reschedule(0.1)
             else:
-                self.timer = threading.Timer(0.1, self.do_message)
+                self.timer = timerScheduler.schedule(0.1, self.do_message)
         finally:
             self.lock.release()
 
@@ -254,6 +331,7 @@ class ExtensiveSearch:
                     name = os.path.basename(self.name)
                     folders = opts
                     opts, opts_script = opts_script
+                    candidates = []
                     for folder in folders:
                         for dirpath, dirnames, filenames in os.walk(folder):
                             for filename in filenames:
@@ -264,7 +342,10 @@ class ExtensiveSearch:
                                             score -= 1
                                         else:
                                             break
-                                    self.queue.put((score, os.path.join(dirpath, filename), opts, opts_script))
+                                    candidates.append((score, os.path.join(dirpath, filename)))
+                    translationunitcache.tuCache.prefetch_options(opts_script, [c[1] for c in candidates])
+                    for score, filename in candidates:
+                        self.queue.put((score, filename, opts, opts_script))
                     for i in range(get_cpu_count()-1):
                         self.queue.put((1001, "*/+++", None, None))
 
@@ -278,39 +359,11 @@ class ExtensiveSearch:
                     self.queue.task_done()
                     break
 
-                remove = translationunitcache.tuCache.get_status(name) == translationunitcache.TranslationUnitCache.STATUS_NOT_IN_CACHE
-                fine_search = not remove
-
-                self.set_status("Searching %s" % name)
-
-                # try a regex search first
-                f = file(name, "r")
-                data = f.read()
-                f.close()
-                match = self.re.search(data)
-                if match != None:
-                    fine_search = True
-                    line, column = parsehelp.get_line_and_column_from_offset(data, match.start())
-                    self.candidates.put((name, "".join(match.groups()), line, column))
-
-                if fine_search and self.cursor and self.impl:
-                    tu2 = translationunitcache.tuCache.get_translation_unit(name, opts, opts_script)
-                    if tu2 != None:
-                        tu2.lock()
-                        try:
-                            cursor2 = cindex.Cursor.get(
-                                    tu2.var, self.cursor.location.file.name,
-                                    self.cursor.location.line,
-                                    self.cursor.location.column)
-                            if not cursor2 is None:
-                                d = cursor2.get_definition()
-                                if not d is None and cursor2 != d:
-                                    self.target = format_cursor(d)
-                                    run_in_main_thread(self.done)
-                        finally:
-                            tu2.unlock()
-                        if remove:
-                            translationunitcache.tuCache.remove(name)
+                executionBudget.acquire(POOL_SEARCH, PRIORITY_SEARCH)
+                try:
+                    self.search(name, opts, opts_script)
+                finally:
+                    executionBudget.release(POOL_SEARCH)
                 self.queue.task_done()
         except Queue.Empty as e:
             pass
@@ -318,6 +371,44 @@ class ExtensiveSearch:
             import traceback
             traceback.print_exc()
 
+    def search(self, name, opts, opts_script):
+        remove = translationunitcache.tuCache.get_status(name) == translationunitcache.TranslationUnitCache.STATUS_NOT_IN_CACHE
+        fine_search = not remove
+
+        self.set_status("Searching %s" % name)
+
+        # try a regex search first
+        f = file(name, "r")
+        data = f.read()
+        f.close()
+        match = self.re.search(data)
+        if match != None:
+            fine_search = True
+            line, column = parsehelp.get_line_and_column_from_offset(data, match.start())
+            self.candidates.put((name, "".join(match.groups()), line, column))
+
+        if fine_search and self.cursor and self.impl:
+            # The options are those of the view the search started from, so
+            # a cached translation unit built with its own options is used
+            # as it is rather than parsed again
+            tu2 = translationunitcache.tuCache.get_translation_unit(name, opts, opts_script, check_options=False)
+            if tu2 != None:
+                tu2.lock_read()
+                try:
+                    cursor2 = cindex.Cursor.get(
+                            tu2.var, self.cursor.location.file.name,
+                            self.cursor.location.line,
+                            self.cursor.location.column)
+                    if not cursor2 is None:
+                        d = cursor2.get_definition()
+                        if not d is None and cursor2 != d:
+                            self.target = format_cursor(d)
+                            run_in_main_thread(self.done)
+                finally:
+                    tu2.unlock_read()
+                if remove:
+                    translationunitcache.tuCache.remove(name, PRIORITY_SEARCH)
+
 class ClangGotoImplementation(sublime_plugin.TextCommand):
 
     def run(self, edit):
@@ -325,7 +416,7 @@ class ClangGotoImplementation(sublime_plugin.TextCommand):
         tu = get_translation_unit(view)
         if tu == None:
             return
-        tu.lock()
+        tu.lock_read()
         target = ""
 
         try:
@@ -372,9 +463,12 @@ class ClangGotoImplementation(sublime_plugin.TextCommand):
                             f = "%s.%s" % (f[:f.rfind(".")], ending)
                             if f != view.file_name() and os.access(f, os.R_OK):
                                 tu2 = get_translation_unit(view, f, True)
-                                if tu2 == None:
+                                if tu2 == None or tu2 is tu:
+                                    # A header view may already be served by the
+                                    # translation unit of this very source file,
+                                    # whose read lock is held and not reentrant
                                     continue
-                                tu2.lock()
+                                tu2.lock_read()
                                 try:
                                     cursor2 = cindex.Cursor.get(
                                             tu2.var, cursor.location.file.name,
@@ -386,12 +480,12 @@ class ClangGotoImplementation(sublime_plugin.TextCommand):
                                             target = format_cursor(d)
                                             break
                                 finally:
-                                    tu2.unlock()
+                                    tu2.unlock_read()
                         if len(target) == 0:
                             ExtensiveSearch(cursor, cursor.spelling, self.view, self.view.window(), cursor.location.file.name)
                             return
         finally:
-            tu.unlock()
+            tu.unlock_read()
         if len(target) > 0:
             open(self.view, target)
         else:
@@ -419,7 +513,7 @@ class ClangGotoDef(sublime_plugin.TextCommand):
         tu = get_translation_unit(view)
         if tu == None:
             return
-        tu.lock()
+        tu.lock_read()
         target = ""
         try:
             row, col = view.rowcol(view.sel()[0].a)
@@ -490,7 +584,7 @@ class ClangGotoDef(sublime_plugin.TextCommand):
                 if not f is None:
                     target = f.name
         finally:
-            tu.unlock()
+            tu.unlock_read()
         if len(target) > 0:
             open(self.view, target)
         else:
@@ -509,14 +603,19 @@ class ClangClearCache(sublime_plugin.TextCommand):
         sublime.status_message("Cache cleared!")
 
 
+class ClangRefreshIncludePaths(sublime_plugin.TextCommand):
+    def run(self, edit):
+        includePathCache.clear()
+        translationunitcache.tuCache.invalidate_options()
+        sublime.status_message("Include paths refreshed!")
+
+
 class ClangReparse(sublime_plugin.TextCommand):
     def run(self, edit):
         view = self.view
-        unsaved_files = []
-        if view.is_dirty():
-            unsaved_files.append((view.file_name(),
-                          view.substr(Region(0, view.size()))))
-        translationunitcache.tuCache.reparse(view, view.file_name(), unsaved_files)
+        views = get_tu_views(view)
+        translationunitcache.tuCache.reparse(view, get_tu_filename(view), get_unsaved_files(views),
+                                             versions=get_versions(views))
 
 
 def ignore_diagnostic(path, ignoreDirs):
@@ -535,7 +634,9 @@ def display_compilation_results(view):
     if tu == None:
         return
 
-    if not tu.try_lock():
+    # Only fails while the file is being reparsed, in which case the
+    # results are displayed again once it's done
+    if not tu.try_lock_read():
         return
     errorCount = 0
     warningCount = 0
@@ -580,7 +681,7 @@ def display_compilation_results(view):
                     diag.severityName, filename, f.line - 1, diag.spelling)
             show = get_setting("show_output_panel", True, view)
     finally:
-        tu.unlock()
+        tu.unlock_read()
     if (errorCount > 0 or warningCount > 0) and get_setting("show_status", True, view):
         statusString = "Clang Status: "
         if errorCount > 0:
@@ -630,19 +731,35 @@ class ClangComplete(sublime_plugin.TextCommand):
 
 
 class SublimeClangAutoComplete(sublime_plugin.EventListener):
+    # Modifications further apart than this many seconds are not
+    # considered part of the same burst of typing
+    TYPING_BURST_GAP = 2.0
+    # Weight of the latest interval in the moving average of the time
+    # between two modifications
+    TYPING_INTERVAL_WEIGHT = 0.3
+    # A reparse is held off for at least this many typing intervals so
+    # that it isn't started between two keystrokes
+    TYPING_PAUSE_FACTOR = 2.0
+
     def __init__(self):
         s = get_settings()
         s.clear_on_change("options")
         s.add_on_change("options", self.load_settings)
         self.load_settings()
         self.recompile_timer = None
+        self.typing = {}
         self.not_code_regex = re.compile("(string.)|(comment.)")
 
     def load_settings(self):
         translationunitcache.tuCache.clear()
+        translationunitcache.tuCache.load_settings()
         self.dont_complete_startswith = get_setting("dont_complete_startswith",
                                               ['operator', '~'])
+        executionBudget.load_settings()
         self.recompile_delay = get_setting("recompile_delay", 1000)
+        self.recompile_delay_min = get_setting("recompile_delay_min", 500)
+        self.recompile_delay_max = get_setting("recompile_delay_max", 5000)
+        self.adaptive_recompile_delay = get_setting("adaptive_recompile_delay", True)
         self.cache_on_load = get_setting("cache_on_load", True)
         self.remove_on_close = get_setting("remove_on_close", True)
         self.time_completions = get_setting("time_completions", False)
@@ -684,7 +801,8 @@ class SublimeClangAutoComplete(sublime_plugin.EventListener):
         if tu == None:
             return self.return_completions([], view)
         ret = None
-        tu.lock()
+        tu.lock_read()
+        exclusive = False
         try:
             if self.time_completions:
                 curr = (time.time() - start)*1000
@@ -695,18 +813,24 @@ class SublimeClangAutoComplete(sublime_plugin.EventListener):
             cached_results = None
             if clang_fast_completions and get_setting("enable_fast_completions", True, view):
                 data = view.substr(sublime.Region(0, locations[0]))
-                cached_results = tu.cache.complete(data, prefix)
+                cached_results = tu.get_cache().complete(data, prefix, view.file_name())
             if cached_results != None:
                 print "found fast completions"
                 ret = cached_results
+            elif tu.from_disk:
+                # clang can't complete in a translation unit loaded from
+                # disk, so it's parsed again for the next completion
+                self.view = view
+                self.restart_recompile_timer(0)
             else:
                 print "doing slow completions"
+                # clang's code completion modifies the translation unit
+                tu.unlock_read()
+                unsaved_files = get_unsaved_files(get_tu_views(view))
+                tu.lock()
+                exclusive = True
                 row, col = view.rowcol(locations[0] - len(prefix))
-                unsaved_files = []
-                if view.is_dirty():
-                    unsaved_files.append((view.file_name(),
-                                      view.substr(Region(0, view.size()))))
-                ret = tu.cache.clangcomplete(view.file_name(), row+1, col+1, unsaved_files, is_member_completion(view, locations[0] - len(prefix)))
+                ret = tu.clang_complete(view.file_name(), row+1, col+1, unsaved_files, is_member_completion(view, locations[0] - len(prefix)))
             if self.time_completions:
                 curr = (time.time() - start)*1000
                 tot += curr
@@ -736,7 +860,10 @@ class SublimeClangAutoComplete(sublime_plugin.EventListener):
                 print timing
                 sublime.status_message(timing)
         finally:
-            tu.unlock()
+            if exclusive:
+                tu.unlock()
+            else:
+                tu.unlock_read()
 
         if not ret is None:
             return self.return_completions(ret, view)
@@ -747,45 +874,95 @@ class SublimeClangAutoComplete(sublime_plugin.EventListener):
 
     def restart_recompile_timer(self, timeout):
         if self.recompile_timer != None:
-            self.recompile_timer.cancel()
-        self.recompile_timer = threading.Timer(timeout, sublime.set_timeout,
-                                               [self.recompile, 0])
-        self.recompile_timer.start()
+            self.recompile_timer.reschedule(timeout)
+        else:
+            self.recompile_timer = timerScheduler.schedule(timeout, sublime.set_timeout,
+                                                           self.recompile, 0)
+
+    def update_typing_interval(self, view):
+        now = time.time()
+        last, interval = self.typing.get(view.id(), (0, None))
+        gap = now - last
+        if gap < SublimeClangAutoComplete.TYPING_BURST_GAP:
+            if interval == None:
+                interval = gap
+            else:
+                weight = SublimeClangAutoComplete.TYPING_INTERVAL_WEIGHT
+                interval = weight * gap + (1 - weight) * interval
+        self.typing[view.id()] = (now, interval)
+
+    def get_recompile_delay(self, view):
+        """
+        Returns the number of seconds to wait after a modification before
+        reparsing. Files that are cheap to reparse are reparsed as soon as
+        typing pauses, while expensive ones wait longer since a reparse
+        started mid-word is wasted and delays the next one.
+        """
+        delay = self.recompile_delay / 1000.0
+        if not self.adaptive_recompile_delay:
+            return delay
+        shortest = self.recompile_delay_min / 1000.0
+        longest = max(shortest, self.recompile_delay_max / 1000.0)
+        cost = translationunitcache.tuCache.get_reparse_time(get_tu_filename(view))
+        if cost == None:
+            # How long it takes to reparse isn't known until it has been
+            # reparsed once
+            return min(max(delay, shortest), longest)
+        interval = self.typing[view.id()][1]
+        if interval != None:
+            cost = max(cost, interval * SublimeClangAutoComplete.TYPING_PAUSE_FACTOR)
+        return min(max(cost, shortest), longest)
 
     def recompile(self):
         view = self.view
-        unsaved_files = []
-        if view.is_dirty():
-            unsaved_files.append((view.file_name(),
-                                  view.substr(Region(0, view.size()))))
-        if not translationunitcache.tuCache.reparse(view, view.file_name(), unsaved_files,
-                        self.reparse_done):
-
-            # Already parsing so retry in a bit
-            self.restart_recompile_timer(1)
+        views = get_tu_views(view)
+        translationunitcache.tuCache.reparse(view, get_tu_filename(view), get_unsaved_files(views),
+                        self.reparse_done, get_view_priority(view), get_versions(views))
 
     def on_activated(self, view):
+        update_open_files()
+        if is_supported_language(view):
+            translationunitcache.tuCache.load_settings(view)
+            translationunitcache.tuCache.set_priority(get_tu_filename(view), PRIORITY_FOREGROUND)
         if is_supported_language(view) and get_setting("reparse_on_activated", True, view):
             self.view = view
-            self.restart_recompile_timer(0.1)
+            views = get_tu_views(view)
+            unsaved_names = [v.file_name() for v in views if v.is_dirty()]
+            if translationunitcache.tuCache.is_stale(get_tu_filename(view), get_versions(views), unsaved_names):
+                self.restart_recompile_timer(0.1)
+            else:
+                display_compilation_results(view)
+
+    def on_deactivated(self, view):
+        if is_supported_language(view):
+            # Work queued for a view that's no longer being edited
+            # shouldn't delay the work for the one that is
+            priority = max(get_view_priority(view), PRIORITY_VISIBLE)
+            translationunitcache.tuCache.set_priority(get_tu_filename(view), priority)
 
     def on_post_save(self, view):
         if is_supported_language(view) and get_setting("reparse_on_save", True, view):
             self.view = view
             self.restart_recompile_timer(0.1)
+        if is_supported_language(view) and get_setting("reparse_dependents_on_save", True, view):
+            translationunitcache.tuCache.reparse_dependents(view.file_name(), get_tu_filename(view))
 
     def on_modified(self, view):
-        if (self.recompile_delay <= 0) or not is_supported_language(view):
+        if (self.recompile_delay <= 0 and not self.adaptive_recompile_delay) or not is_supported_language(view):
             return
 
         self.view = view
-        self.restart_recompile_timer(self.recompile_delay / 1000.0)
+        self.update_typing_interval(view)
+        self.restart_recompile_timer(self.get_recompile_delay(view))
 
     def on_load(self, view):
+        update_open_files()
         if self.cache_on_load and is_supported_language(view):
             warm_up_cache(view)
 
     def on_close(self, view):
+        update_open_files(view.id())
+        self.typing.pop(view.id(), None)
         if self.remove_on_close and is_supported_language(view):
             translationunitcache.tuCache.remove(view.file_name())
 
@@ -802,3 +979,21 @@ class SublimeClangAutoComplete(sublime_plugin.EventListener):
             return get_setting("automatic_completion_popup", True, view)
         elif key == "clang_panel_visible":
             return clang_error_panel.is_visible()
+
+
+def plugin_loaded():
+    # The visible views restored from the last session are queued up
+    # before the workers are let go, so that they're parsed before
+    # anything else and the active view first of all
+    try:
+        if get_setting("cache_on_load", True):
+            update_open_files()
+            for window in sublime.windows():
+                for group in range(window.num_groups()):
+                    view = window.active_view_in_group(group)
+                    if view != None and view.file_name() != None and is_supported_language(view):
+                        warm_up_cache(view)
+    finally:
+        workersReady.set()
+
+sublime.set_timeout(plugin_loaded, 0)
@@ -20,9 +20,12 @@ freely, subject to the following restrictions:
    3. This notice may not be removed or altered from any source
    distribution.
 """
-from common import Worker, expand_path, get_setting, get_path_setting, get_language, LockedVariable, run_in_main_thread, error_message
+from common import Worker, expand_path, get_setting, get_path_setting, get_language, LockedVariable, ReadWriteLockedVariable, run_in_main_thread, error_message, find_views, \
+                   includePathCache, PRIORITY_FOREGROUND, PRIORITY_VISIBLE, PRIORITY_BACKGROUND, PRIORITY_SEARCH, POOL_TRANSLATION_UNIT
 from clang import cindex
+from compilationdatabase import CompilationDatabase, normalize_path
 import time
+import threading
 import shlex
 import subprocess
 from ctypes import cdll, Structure, POINTER, c_char_p, c_void_p, c_uint, c_bool
@@ -30,10 +33,10 @@ from parsehelp.parsehelp import *
 import re
 import os
 import json
+import hashlib
 
 scriptpath = os.path.dirname(os.path.abspath(__file__))
 
-compilation_database_pattern = re.compile('(?<=\s)-[DIOUWfgs][^=\s]+(?:=\\"[^"]+\\"|=[^"]\S+)?')
 
 def get_cache_library():
     import platform
@@ -81,6 +84,20 @@ class CacheCompletionResults(Structure):
 
 
 cachelib = get_cache_library()
+
+
+def get_optional_function(name, argtypes, restype=None):
+    """
+    Returns the function from the cache library, or None if the library
+    was built before the function was added to it
+    """
+    func = getattr(cachelib, name, None)
+    if func != None:
+        func.argtypes = argtypes
+        if restype != None:
+            func.restype = restype
+    return func
+
 _createCache = cachelib.createCache
 _createCache.restype = c_void_p
 _createCache.argtypes = [cindex.Cursor]
@@ -92,6 +109,8 @@ cache_completeNamespace.restype = POINTER(CacheCompletionResults)
 cache_complete_startswith = cachelib.cache_complete_startswith
 cache_complete_startswith.argtypes = [c_void_p, c_char_p]
 cache_complete_startswith.restype = POINTER(CacheCompletionResults)
+cache_complete_startswith_ignorecase = get_optional_function("cache_complete_startswith_ignorecase", [c_void_p, c_char_p], POINTER(CacheCompletionResults))
+cache_complete_fuzzy = get_optional_function("cache_complete_fuzzy", [c_void_p, c_char_p, c_uint], POINTER(CacheCompletionResults))
 cache_disposeCompletionResults = cachelib.cache_disposeCompletionResults
 cache_disposeCompletionResults.argtypes = [POINTER(CacheCompletionResults)]
 cache_findType = cachelib.cache_findType
@@ -103,6 +122,50 @@ cache_completeCursor.restype = POINTER(CacheCompletionResults)
 cache_clangComplete = cachelib.cache_clangComplete
 cache_clangComplete.argtypes = [c_void_p, c_char_p, c_uint, c_uint, POINTER(cindex._CXUnsavedFile), c_uint, c_bool]
 cache_clangComplete.restype = POINTER(CacheCompletionResults)
+clangComplete = get_optional_function("clangComplete", [cindex.TranslationUnit, c_char_p, c_uint, c_uint, POINTER(cindex._CXUnsavedFile), c_uint, c_bool], POINTER(CacheCompletionResults))
+cache_update = get_optional_function("cache_update", [c_void_p, cindex.Cursor, POINTER(c_char_p), c_uint])
+cache_getEntryCount = get_optional_function("cache_getEntryCount", [c_void_p], c_uint)
+
+# Rough number of bytes used by a single entry in the native cache,
+# including its display and insertion strings and its share of the
+# prefix index
+CACHE_ENTRY_SIZE_ESTIMATE = 190
+
+# Minimum number of seconds between checks of whether the compilation
+# database has been modified
+DATABASE_CHECK_INTERVAL = 2
+
+# Weight of the latest reparse in the moving average of the time it
+# takes to reparse a file
+REPARSE_TIME_WEIGHT = 0.3
+
+HEADER_EXTENSIONS = (".h", ".hh", ".hpp", ".hxx", ".h++", ".inl", ".ipp")
+SOURCE_LANGUAGES = {".c": "c", ".m": "objc", ".mm": "objc++"}
+
+
+def is_header(filename):
+    return os.path.splitext(filename)[1].lower() in HEADER_EXTENSIONS
+
+
+def get_unsaved_files_array(unsaved_files):
+    unsaved = None
+    if len(unsaved_files):
+        unsaved = (cindex._CXUnsavedFile * len(unsaved_files))()
+        for i, (name, value) in enumerate(unsaved_files):
+            if not isinstance(value, str):
+                value = value.encode("ascii", "ignore")
+            unsaved[i].name = name
+            unsaved[i].contents = value
+            unsaved[i].length = len(value)
+    return unsaved
+
+
+def get_clang_completions(comp):
+    ret = None
+    if comp:
+        ret = [(c.display, c.insert) for c in comp[0]]
+        cache_disposeCompletionResults(comp)
+    return ret
 
 
 def remove_duplicates(data):
@@ -125,11 +188,57 @@ class Cache:
             raise Exception("cache is None")
         self.tu = tu
         self.filename = filename
+        # The native cache fills in its table of class members as they
+        # are completed, and builds its case insensitive index when first
+        # queried, which readers sharing the translation unit mustn't do
+        # at the same time
+        self.lazy_lock = threading.Lock()
 
     def __del__(self):
         if self.cache:
             _deleteCache(self.cache)
 
+    def complete_cursor(self, cursor):
+        self.lazy_lock.acquire()
+        try:
+            return cache_completeCursor(self.cache, cursor)
+        finally:
+            self.lazy_lock.release()
+
+    def complete_prefix(self, prefix):
+        if cache_complete_startswith_ignorecase == None or not get_setting("case_insensitive_completions", False):
+            return cache_complete_startswith(self.cache, prefix)
+        self.lazy_lock.acquire()
+        try:
+            return cache_complete_startswith_ignorecase(self.cache, prefix)
+        finally:
+            self.lazy_lock.release()
+
+    def get_entry_count(self):
+        if cache_getEntryCount == None:
+            return 0
+        return cache_getEntryCount(self.cache)
+
+    def update(self, changed_files):
+        """
+        Updates the cache after the translation unit has been reparsed,
+        only recreating the entries that come from the changed files.
+        """
+        if cache_update == None:
+            # Older cache libraries can only build it from scratch
+            cache = _createCache(self.tu.cursor)
+            if cache == None:
+                raise Exception("cache is None")
+            _deleteCache(self.cache)
+            self.cache = cache
+            return
+        files = (c_char_p*len(changed_files))()
+        for i, name in enumerate(changed_files):
+            if isinstance(name, unicode):
+                name = name.encode("utf-8")
+            files[i] = name
+        cache_update(self.cache, self.tu.cursor, files, len(changed_files))
+
     def get_native_namespace(self, namespace):
         nsarg = (c_char_p*len(namespace))()
         for i in range(len(namespace)):
@@ -262,7 +371,12 @@ class Cache:
                         return self.inherits(parent, c2)
         return False
 
-    def complete(self, data, prefix):
+    def complete(self, data, prefix, filename=None):
+        # The file being completed in, which for a header served by the
+        # translation unit of a source file including it isn't the file
+        # the translation unit was parsed from
+        if filename == None:
+            filename = self.filename
         line = extract_line_at_offset(data, len(data)-1)
         before = line
         if len(prefix) > 0:
@@ -313,7 +427,7 @@ class Cache:
                     if c.kind == cindex.CursorKind.NAMESPACE:
                         namespace = self.get_namespace_from_cursor(c)
                         return self.complete_namespace(namespace)
-                    comp = cache_completeCursor(self.cache, c)
+                    comp = self.complete_cursor(c)
 
                     if comp:
                         inherits = False
@@ -357,7 +471,7 @@ class Cache:
 
             if not var is None:
                 if line > 0 and column > 0:
-                    cursor = cindex.Cursor.get(self.tu, self.filename, line, column)
+                    cursor = cindex.Cursor.get(self.tu, filename, line, column)
                 if cursor is None or cursor.kind.is_invalid() or cursor.spelling != var:
                     cursor = self.find_type(data, template[0])
                 else:
@@ -519,7 +633,7 @@ class Cache:
                     if clazz == None:
                         clazz = extract_class(data)
                     selfcompletion = clazz == r.spelling
-                    comp = cache_completeCursor(self.cache, r)
+                    comp = self.complete_cursor(r)
                     replaces = []
                     if template[1] != None:
                         tempnames = []
@@ -576,7 +690,11 @@ class Cache:
                         cache_disposeCompletionResults(comp)
             return remove_duplicates(ret)
         else:
-            cached_results = cache_complete_startswith(self.cache, prefix)
+            if len(prefix) > 0 and cache_complete_fuzzy != None and get_setting("fuzzy_completions", False):
+                limit = get_setting("fuzzy_completions_limit", 200)
+                cached_results = cache_complete_fuzzy(self.cache, prefix, limit)
+            else:
+                cached_results = self.complete_prefix(prefix)
             if cached_results:
                 ret = [(x.display, x.insert) for x in cached_results[0]]
                 cache_disposeCompletionResults(cached_results)
@@ -584,8 +702,9 @@ class Cache:
             var = [("%s\t%s" % (v[1], re.sub(r"(^|\b)\s*static\s+", "", v[0])), v[1]) for v in variables]
             if len(var) and ret == None:
                 ret = []
+            ignore_case = get_setting("case_insensitive_completions", False)
             for v in var:
-                if v[1].startswith(prefix):
+                if v[1].startswith(prefix) or (ignore_case and v[1].lower().startswith(prefix.lower())):
                     ret.append(v)
             clazz = extract_class_from_function(data)
             if clazz == None:
@@ -593,7 +712,7 @@ class Cache:
             if clazz != None:
                 c = self.find_type(data, clazz)
                 if not c is None and not c.kind.is_invalid():
-                    comp = cache_completeCursor(self.cache, c)
+                    comp = self.complete_cursor(c)
                     if comp:
                         for c in comp[0]:
                             if not c.static and \
@@ -613,22 +732,300 @@ class Cache:
         return remove_duplicates(ret)
 
     def clangcomplete(self, filename, row, col, unsaved_files, membercomp):
-        ret = None
-        unsaved = None
-        if len(unsaved_files):
-            unsaved = (cindex._CXUnsavedFile * len(unsaved_files))()
-            for i, (name, value) in enumerate(unsaved_files):
-                if not isinstance(value, str):
-                    value = value.encode("ascii", "ignore")
-                unsaved[i].name = name
-                unsaved[i].contents = value
-                unsaved[i].length = len(value)
+        unsaved = get_unsaved_files_array(unsaved_files)
         comp = cache_clangComplete(self.cache, filename, row, col, unsaved, len(unsaved_files), membercomp)
+        return get_clang_completions(comp)
+
+
+class CompileOptions(list):
+    """
+    A list of compiler options that remembers its fingerprint, a hash of
+    the options normalized so that "-D FOO" and "-DFOO" are the same.
+    The list must not be modified once the fingerprint has been taken.
+    """
+    # Options that may be given their argument as the next option
+    SEPARATE_ARGUMENT = set(["-D", "-U", "-I", "-F", "-x", "-isystem", "-iquote", "-idirafter",
+                             "-include", "-imacros", "-arch", "-Xclang"])
+
+    def __init__(self, opts=[]):
+        list.__init__(self, opts)
+        self.fingerprint = None
+
+    def normalize(self):
+        # The order is kept since later options override earlier ones,
+        # as in "-DFOO=1 -DFOO=2" or "-fno-rtti -frtti"
+        normalized = []
+        i = 0
+        while i < len(self):
+            opt = self[i]
+            if opt in CompileOptions.SEPARATE_ARGUMENT and i + 1 < len(self):
+                i += 1
+                opt += self[i]
+            normalized.append(opt)
+            i += 1
+        return tuple(normalized)
+
+    def get_fingerprint(self):
+        if self.fingerprint == None:
+            self.fingerprint = hash(self.normalize())
+        return self.fingerprint
+
+
+def get_fingerprint(opts):
+    if not isinstance(opts, CompileOptions):
+        opts = CompileOptions(opts)
+    return opts.get_fingerprint()
+
+
+def get_dependencies(tu, filename):
+    """
+    Returns a dictionary mapping the file and every file it includes to
+    the modification time clang saw when it read it.
+    """
+    files = {}
+    f = tu.get_file(filename)
+    if f != None:
+        files[filename] = f.time
+    for inc in tu.get_includes():
+        files[inc.include.name] = inc.include.time
+    return files
+
+
+def is_modified(files):
+    """
+    Returns True if any of the files have been modified since the
+    dependencies were gathered, or can no longer be found.
+    """
+    try:
+        for name, mtime in files.items():
+            if int(os.path.getmtime(name)) != mtime:
+                return True
+    except OSError:
+        return True
+    return False
+
+
+def get_changed_files(old, new):
+    """
+    Returns the files in the new dependencies that are either new or
+    have been modified since the old dependencies were gathered.
+    """
+    return [name for name, mtime in new.items() if old.get(name) != mtime]
+
+
+class TranslationUnitDiskCache:
+    """
+    Stores parsed translation units on disk so that they can be loaded
+    rather than parsed again after a restart. An entry is keyed by the file
+    and the options it was compiled with, and is only used if none of the
+    files it depends on have been modified since it was saved.
+
+    Once the stored files take more than max_size bytes, the least
+    recently used ones are removed.
+    """
+    def __init__(self):
+        self.path = None
+        self.max_size = 0
+
+    def get_basename(self, filename, opts):
+        key = hashlib.md5()
+        for opt in [filename] + opts:
+            if isinstance(opt, unicode):
+                opt = opt.encode("utf-8")
+            key.update(opt)
+            key.update("\0")
+        return os.path.join(self.path, key.hexdigest())
+
+    def is_valid(self, files):
+        return not is_modified(files)
+
+    def load(self, index, filename, opts):
+        if not self.path:
+            return None
+        basename = self.get_basename(filename, opts)
+        try:
+            with open("%s.json" % basename) as f:
+                files = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if not self.is_valid(files):
+            return None
+        try:
+            # Marks the entry as recently used
+            os.utime("%s.json" % basename, None)
+        except OSError:
+            pass
+        return index.read("%s.ast" % basename)
+
+    def save(self, tu, filename, opts, files):
+        if not self.path:
+            return
+        try:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            basename = self.get_basename(filename, opts)
+            if os.path.exists("%s.json" % basename):
+                # Invalidate the old entry before its ast file is overwritten
+                os.remove("%s.json" % basename)
+            if not tu.save("%s.ast" % basename):
+                return
+            with open("%s.json" % basename, "w") as f:
+                json.dump(files, f)
+            self.prune()
+        except (IOError, OSError):
+            import traceback
+            traceback.print_exc()
+
+    def prune(self):
+        if self.max_size <= 0:
+            return
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith(".json"):
+                continue
+            basename = os.path.join(self.path, name[:-5])
+            try:
+                size = os.path.getsize("%s.ast" % basename)
+                used = os.path.getmtime("%s.json" % basename)
+            except OSError:
+                continue
+            entries.append((used, size, basename))
+            total += size
+        entries.sort()
+        for used, size, basename in entries:
+            if total <= self.max_size:
+                break
+            for ext in (".json", ".ast"):
+                try:
+                    os.remove(basename + ext)
+                except OSError:
+                    pass
+            total -= size
 
-        if comp:
-            ret = [(c.display, c.insert) for c in comp[0]]
-            cache_disposeCompletionResults(comp)
-        return ret
+
+class OptionsScriptCache:
+    """
+    Remembers the options printed by the options_script so that it isn't
+    run every time a file is parsed. Results are kept for ttl seconds and
+    are thrown away early if any of the dependency files is modified.
+
+    In batch mode the script can be given many files at once, in which
+    case it's expected to print the options of each file on a line of
+    its own in the order the files were given.
+    """
+    # The most characters of file names to give the script at once in
+    # batch mode, well below the command line limit of every platform
+    BATCH_SIZE = 16000
+
+    def __init__(self):
+        self.entries = LockedVariable({})
+        self.ttl = 0
+        self.dependencies = []
+        self.batch = False
+
+    def get_mtimes(self):
+        mtimes = []
+        for name in self.dependencies:
+            try:
+                mtimes.append(os.path.getmtime(name))
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def lookup(self, entries, key, mtimes, now):
+        if key in entries:
+            opts, timestamp, deps = entries[key]
+            if now - timestamp < self.ttl and deps == mtimes:
+                return opts
+            del entries[key]
+        return None
+
+    def run(self, script, filenames):
+        # shlex.split barfs if fed with an unicode strings
+        args = shlex.split(script.encode()) + filenames
+        try:
+            process = subprocess.Popen(args, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+            output = process.communicate()
+        except OSError as e:
+            print "The options_script couldn't be run: %s" % e
+            return None
+        if process.returncode:
+            print "The options_script failed with code [%s]" % process.returncode
+            print output[1]
+            return None
+        return output[0]
+
+    def store(self, script, items, mtimes, now):
+        if self.ttl <= 0:
+            return
+        entries = self.entries.lock()
+        try:
+            for filename, opts in items:
+                entries[(script, filename)] = (opts, now, mtimes)
+        finally:
+            self.entries.unlock()
+
+    def get(self, script, filename):
+        mtimes = self.get_mtimes()
+        now = time.time()
+        entries = self.entries.lock()
+        try:
+            opts = self.lookup(entries, (script, filename), mtimes, now)
+        finally:
+            self.entries.unlock()
+        if opts == None:
+            output = self.run(script, [filename])
+            if output == None:
+                return []
+            opts = shlex.split(output)
+            self.store(script, [(filename, opts)], mtimes, now)
+        return list(opts)
+
+    def prefetch(self, script, filenames):
+        """
+        Runs the script once for all of the files that don't have
+        options cached yet. Does nothing unless in batch mode.
+        """
+        if not self.batch or self.ttl <= 0:
+            return
+        mtimes = self.get_mtimes()
+        now = time.time()
+        entries = self.entries.lock()
+        try:
+            missing = [fn for fn in filenames if self.lookup(entries, (script, fn), mtimes, now) == None]
+        finally:
+            self.entries.unlock()
+        # The files are given in chunks so that the command line
+        # doesn't get too long on large projects
+        chunk = []
+        length = 0
+        for fn in missing:
+            if len(chunk) and length + len(fn) + 1 > OptionsScriptCache.BATCH_SIZE:
+                self.prefetch_chunk(script, chunk, mtimes, now)
+                chunk = []
+                length = 0
+            chunk.append(fn)
+            length += len(fn) + 1
+        if len(chunk):
+            self.prefetch_chunk(script, chunk, mtimes, now)
+
+    def prefetch_chunk(self, script, filenames, mtimes, now):
+        output = self.run(script, filenames)
+        if output == None:
+            return
+        lines = output.splitlines()
+        if len(lines) != len(filenames):
+            print "The options_script printed %d lines for %d files" % (len(lines), len(filenames))
+            return
+        self.store(script, [(fn, shlex.split(line)) for fn, line in zip(filenames, lines)], mtimes, now)
+
+    def clear(self):
+        entries = self.entries.lock()
+        try:
+            entries.clear()
+        finally:
+            self.entries.unlock()
 
 
 class TranslationUnitCache(Worker):
@@ -637,30 +1034,138 @@ class TranslationUnitCache(Worker):
     STATUS_READY        = 3
     STATUS_NOT_IN_CACHE = 4
 
-    class LockedTranslationUnit(LockedVariable):
+    class LockedTranslationUnit(ReadWriteLockedVariable):
+        """
+        Queries that only read from the translation unit take the read
+        lock and can run concurrently. Anything that modifies it, such as
+        reparsing or clang's code completion, takes the lock exclusively.
+        """
         def __init__(self, var, fn):
-            LockedVariable.__init__(self, var)
-            self.cache = Cache(var, fn)
+            ReadWriteLockedVariable.__init__(self, var)
+            self.filename = fn
+            # The cache is only built once it's needed. Every reparse
+            # bumps the generation, and the files changed since the
+            # cache was last brought up to date are collected so that it
+            # can be updated rather than rebuilt when next used.
+            self.cache = None
+            self.generation = 0
+            self.cache_generation = 0
+            self.changed_files = set()
+            self.cache_lock = threading.Lock()
+            self.last_used = time.time()
+            self.memory_usage = 0
+            self.from_disk = False
+            self.saved_dependencies = None
+            self.fingerprint = None
+            # The change count of each open file of the translation
+            # unit when it was last reparsed, so that it doesn't need to
+            # be reparsed when a view that hasn't changed is activated
+            self.versions = {}
+            self.unsaved_names = []
+            self.update_memory_usage()
+            self.update_dependencies(fn)
+
+        def get_cache(self):
+            # Must be called with the lock held, at least for reading.
+            # Several readers may get here at once, so building or
+            # updating the cache is serialized with a lock of its own.
+            self.cache_lock.acquire()
+            try:
+                if self.cache == None:
+                    self.cache = Cache(self.var, self.filename)
+                elif self.cache_generation != self.generation:
+                    self.cache.update(list(self.changed_files))
+                else:
+                    return self.cache
+                self.cache_generation = self.generation
+                self.changed_files.clear()
+                self.update_memory_usage()
+                return self.cache
+            finally:
+                self.cache_lock.release()
+
+        def clang_complete(self, filename, row, col, unsaved_files, membercomp):
+            # Must be called with the lock held exclusively. Only cache
+            # libraries from before clangComplete was added need the
+            # cache to be built for it.
+            if clangComplete == None:
+                return self.get_cache().clangcomplete(filename, row, col, unsaved_files, membercomp)
+            unsaved = get_unsaved_files_array(unsaved_files)
+            comp = clangComplete(self.var, filename, row, col, unsaved, len(unsaved_files), membercomp)
+            return get_clang_completions(comp)
+
+        def reparsed(self, changed_files):
+            self.generation += 1
+            if self.cache != None:
+                self.changed_files.update(changed_files)
+
+        def update_dependencies(self, fn):
+            self.dependencies = get_dependencies(self.var, fn)
+
+        def update_memory_usage(self):
+            # Must be called with the lock held or before the
+            # translation unit has been made available to other threads
+            self.memory_usage = self.var.get_memory_usage()
+            if self.cache != None:
+                self.memory_usage += self.cache.get_entry_count() * CACHE_ENTRY_SIZE_ESTIMATE
+
+    class FileState:
+        """
+        The pending work for a file. A file without any pending work
+        has no state at all.
+
+            parsing   - a parse is queued or running
+            reparse   - the latest reparse request not yet started
+            reparsing - a reparse is running
+        """
+        def __init__(self):
+            self.parsing = False
+            self.reparse = None
+            self.reparsing = False
+
+        def is_idle(self):
+            return not self.parsing and self.reparse == None and not self.reparsing
 
     def __init__(self):
         workerthreadcount = get_setting("worker_threadcount", -1)
         self.as_super = super(TranslationUnitCache, self)
-        self.as_super.__init__(workerthreadcount)
+        self.as_super.__init__(workerthreadcount, POOL_TRANSLATION_UNIT)
         self.translationUnits = LockedVariable({})
-        self.parsingList = LockedVariable([])
-        self.busyList = LockedVariable([])
+        self.fileStates = LockedVariable({})
         self.index_parse_options = 13
         self.index = None
         self.debug_options = False
         self.compilation_database = None
+        self.database_checked = 0
+        self.memory_budget = 0
+        self.evict_open_views = False
+        self.diskCache = TranslationUnitDiskCache()
+        self.optionsScriptCache = OptionsScriptCache()
+        # The options of each view are built once and reused until the
+        # settings, the compilation database or the directories of an
+        # expanded include path change, which bumps the generation
+        self.optionsCache = LockedVariable({})
+        self.optionsGeneration = 0
+        # Maps each included file to the cached translation units including
+        # it, and headers to the translation unit last chosen to serve them
+        self.includedBy = LockedVariable({})
+        self.headerSources = {}
+        # Translation units waiting to be reparsed because a file they
+        # include was saved, and the ones being reparsed for that reason
+        self.dependentReparses = LockedVariable([])
+        self.dependentsInFlight = set()
+        self.dependentConcurrency = 1
+        self.openFiles = LockedVariable((set(), set()))
+        # Moving average of the number of seconds each file takes to reparse
+        self.reparseTimes = LockedVariable({})
 
     def get_status(self, filename):
         tu = self.translationUnits.lock()
-        pl = self.parsingList.lock()
+        fs = self.fileStates.lock()
         a = filename in tu
-        b = filename in pl
+        b = filename in fs
+        self.fileStates.unlock()
         self.translationUnits.unlock()
-        self.parsingList.unlock()
         if a and b:
             return TranslationUnitCache.STATUS_REPARSING
         elif a:
@@ -674,110 +1179,172 @@ class TranslationUnitCache(Worker):
         if get_setting("parse_status_messages", True):
             self.as_super.display_status()
 
-    def add_busy(self, filename, task, data):
-        bl = self.busyList.lock()
-        test = filename in bl
+    def get_file_state(self, fs, filename):
+        if filename not in fs:
+            fs[filename] = TranslationUnitCache.FileState()
+        return fs[filename]
 
-        if test:
-            self.busyList.unlock()
-            # Another thread is already doing something with
-            # this file, so try again later
-            if self.tasks.empty():
-                try:
-                    time.sleep(1)
-                except:
-                    pass
-            self.tasks.put((task, data))
-            return True
-        else:
-            bl.append(filename)
-            self.busyList.unlock()
-        return False
+    def release_file_state(self, fs, filename):
+        if filename in fs and fs[filename].is_idle():
+            del fs[filename]
 
-    def remove_busy(self, filename):
-        bl = self.busyList.lock()
+    def parse_done(self, filename):
+        fs = self.fileStates.lock()
         try:
-            bl.remove(filename)
+            if filename in fs:
+                fs[filename].parsing = False
+                self.release_file_state(fs, filename)
         finally:
-            self.busyList.unlock()
+            self.fileStates.unlock()
+
+    # Tasks are queued with the file name as the key, so the worker
+    # never runs two tasks for the same file at the same time.
 
     def task_parse(self, data):
         filename, opts, opts_script, on_done = data
-        if self.add_busy(filename, self.task_parse, data):
-            return
         try:
             self.set_status("Parsing %s" % filename)
             self.get_translation_unit(filename, opts, opts_script)
             self.set_status("Parsing %s done" % filename)
         finally:
-            l = self.parsingList.lock()
-            try:
-                l.remove(filename)
-            finally:
-                self.parsingList.unlock()
-                self.remove_busy(filename)
+            self.parse_done(filename)
+        self.evict()
         if not on_done is None:
             run_in_main_thread(on_done)
 
-    def task_reparse(self, data):
-        filename, opts, opts_script, unsaved_files, on_done = data
-        if self.add_busy(filename, self.task_reparse, data):
+    def task_reparse(self, filename):
+        request = None
+        fs = self.fileStates.lock()
+        try:
+            state = fs.get(filename)
+            if state != None and state.reparse != None:
+                request = state.reparse
+                state.reparse = None
+                state.reparsing = True
+        finally:
+            self.fileStates.unlock()
+        if request == None:
+            # The request was cancelled
             return
+        versions, opts, opts_script, unsaved_files, on_done, priority = request
+        again = False
         try:
             self.set_status("Reparsing %s" % filename)
             tu = self.get_translation_unit(filename, opts, opts_script, unsaved_files)
-            if tu != None:
+            if tu != None and tu.from_disk:
+                # Translation units loaded from disk lack the compiler
+                # invocation needed to reparse them, so it's parsed from
+                # scratch instead. It's only reparsed once something it
+                # was parsed from has changed.
+                tus = self.translationUnits.lock()
+                try:
+                    if tus.get(filename) is tu:
+                        del tus[filename]
+                finally:
+                    self.translationUnits.unlock()
+                tu = self.get_translation_unit(filename, opts, opts_script, unsaved_files, False)
+                if tu != None:
+                    tu.lock()
+                    try:
+                        if versions != None:
+                            tu.versions.update(versions)
+                        tu.unsaved_names = [name for name, value in unsaved_files]
+                    finally:
+                        tu.unlock()
+                self.set_status("Reparsing %s done" % filename)
+            elif tu != None:
                 tu.lock()
                 try:
+                    old_dependencies = tu.dependencies
+                    start = time.time()
                     tu.var.reparse(unsaved_files)
-                    tu.cache = Cache(tu.var, filename)
+                    self.add_reparse_time(filename, time.time() - start)
+                    if versions != None:
+                        tu.versions.update(versions)
+                    tu.update_dependencies(filename)
+                    self.update_include_index(filename, old_dependencies, tu.dependencies)
+                    # Buffers that are, or were last time, unsaved can
+                    # differ from the file on disk whatever its mtime
+                    unsaved_names = [name for name, value in unsaved_files]
+                    changed = set(get_changed_files(old_dependencies, tu.dependencies))
+                    changed.update(unsaved_names)
+                    changed.update(tu.unsaved_names)
+                    changed.add(filename)
+                    tu.unsaved_names = unsaved_names
+                    tu.reparsed(changed)
+                    tu.update_memory_usage()
                     self.set_status("Reparsing %s done" % filename)
                 finally:
                     tu.unlock()
+                self.refresh_cache(tu)
+                if len(unsaved_files) == 0:
+                    self.save_to_disk(tu, filename)
         finally:
-            l = self.parsingList.lock()
+            fs = self.fileStates.lock()
             try:
-                l.remove(filename)
+                state = fs[filename]
+                state.reparsing = False
+                if state.reparse != None:
+                    # The buffer was modified while reparsing, so
+                    # do it again with the latest contents
+                    again = True
+                    self.add_task(self.task_reparse, filename, state.reparse[5], filename)
+                else:
+                    self.release_file_state(fs, filename)
             finally:
-                self.parsingList.unlock()
-                self.remove_busy(filename)
-        if not on_done is None:
+                self.fileStates.unlock()
+        self.evict()
+        self.start_dependent_reparses()
+        if not again and not on_done is None:
             run_in_main_thread(on_done)
 
     def task_parse_database(self, data):
         filename, on_done = data
-        if self.add_busy(filename, self.task_parse_database, data):
-            return
         try:
             self.set_status('Parsing compilation database: %s' % filename)
-            with open(filename) as compilation_database_file:
-                compilation_database_entries = json.load(compilation_database_file)
-
-            total = len(compilation_database_entries)
-            entry = 0
-            for compilation_entry in compilation_database_entries:
-                entry = entry + 1
-                self.set_status('Parsing compilation database: %s (%d/%d)' % (filename, entry, total))
-                entry_folder = os.path.dirname(compilation_entry["file"])
-                if entry_folder not in self.compilation_database:
-                    self.compilation_database[entry_folder] = []
-
-                self.compilation_database[entry_folder].extend([ p.strip() for p in compilation_database_pattern.findall(compilation_entry["command"]) ])
-
-            for k,v in self.compilation_database.items():
-                self.compilation_database[k] = list(set(self.compilation_database[k]))
-
-            self.set_status("Parsing %s done" % filename)
-        finally:
-            l = self.parsingList.lock()
+            database = self.compilation_database
+            tus = self.translationUnits.lock()
+            of = self.openFiles.lock()
             try:
-                l.remove(filename)
+                openFiles = [fn for fn in of[0] if fn in tus]
             finally:
-                self.parsingList.unlock()
-                self.remove_busy(filename)
+                self.openFiles.unlock()
+                self.translationUnits.unlock()
+            old_opts = dict((fn, database.get_opts(fn)) for fn in openFiles)
+            try:
+                database.load(filename, lambda count: self.set_status('Parsing compilation database: %s (%d)' % (filename, count)))
+            except (IOError, ValueError):
+                import traceback
+                traceback.print_exc()
+            self.invalidate_options()
+            self.set_status("Parsing %s done" % filename)
+            changed = [fn for fn in openFiles if database.get_opts(fn) != old_opts[fn]]
+            if len(changed):
+                self.reload_translation_units(changed)
+        finally:
+            self.parse_done(filename)
         if not on_done is None:
             run_in_main_thread(on_done)
 
+    def reload_translation_units(self, filenames):
+        """
+        Drops the translation units of the files and parses them again
+        with the options of the views they are open in.
+        """
+        tus = self.translationUnits.lock()
+        try:
+            for filename in filenames:
+                tus.pop(filename, None)
+        finally:
+            self.translationUnits.unlock()
+
+        def add():
+            for filename in filenames:
+                views = find_views(filename)
+                if len(views):
+                    self.add(views[0], filename, None, PRIORITY_VISIBLE)
+        run_in_main_thread(add)
+
     def task_clear(self, data):
         tus = self.translationUnits.lock()
         try:
@@ -786,100 +1353,426 @@ class TranslationUnitCache(Worker):
             self.translationUnits.unlock()
 
     def task_remove(self, data):
-        if self.add_busy(data, self.task_remove, data):
+        tus = self.translationUnits.lock()
+        try:
+            if data in tus:
+                tus.pop(data)
+        finally:
+            self.translationUnits.unlock()
+
+    def task_evict(self, data):
+        self.evict()
+
+    def evict(self):
+        """
+        Drops the least recently used translation units until the memory
+        used by the cache fits within the configured budget. Translation
+        units with an open view are kept, unless evict_open_views is set
+        in which case they are only dropped once all other candidates have
+        been exhausted. The ones of visible views are never dropped.
+        """
+        if self.memory_budget <= 0:
             return
+        tus = self.translationUnits.lock()
+        fs = self.fileStates.lock()
+        of = self.openFiles.lock()
         try:
-            tus = self.translationUnits.lock()
-            try:
-                if data in tus:
-                    tus.pop(data)
-            finally:
-                self.translationUnits.unlock()
+            total = 0
+            for tu in tus.values():
+                total += tu.memory_usage
+            if total <= self.memory_budget:
+                return
+            openFiles, visibleFiles = of
+            candidates = []
+            for filename, tu in tus.items():
+                if filename in visibleFiles or filename in fs or \
+                        (filename in openFiles and not self.evict_open_views):
+                    continue
+                candidates.append((filename in openFiles, tu.last_used, filename))
+            candidates.sort()
+            for isOpen, lastUsed, filename in candidates:
+                if total <= self.memory_budget:
+                    break
+                total -= tus[filename].memory_usage
+                del tus[filename]
         finally:
-            self.remove_busy(data)
+            self.openFiles.unlock()
+            self.fileStates.unlock()
+            self.translationUnits.unlock()
+
+    def set_open_files(self, openFiles, visibleFiles):
+        self.openFiles.lock()
+        self.openFiles.var = (set(openFiles), set(visibleFiles))
+        self.openFiles.unlock()
+        self.add_task(self.task_evict, None, PRIORITY_SEARCH)
+
+    def check_database(self):
+        """
+        Loads the compilation database if it hasn't been loaded yet or has
+        been modified since. The file is looked at no more than once every
+        DATABASE_CHECK_INTERVAL seconds.
+        """
+        if self.compilation_database is None:
+            self.parse_database()
+            return
+        now = time.time()
+        if now - self.database_checked < DATABASE_CHECK_INTERVAL:
+            return
+        self.database_checked = now
+        filename = expand_path(get_setting("compilation_database", None), None)
+        if filename is None:
+            if self.compilation_database.path is not None:
+                self.compilation_database = CompilationDatabase()
+        elif self.compilation_database.is_modified(filename):
+            self.parse_database()
 
     def parse_database(self, on_done=None):
         ret = False
-        self.compilation_database = {}
+        if self.compilation_database is None:
+            self.compilation_database = CompilationDatabase()
+        self.database_checked = time.time()
 
         filename = expand_path(get_setting("compilation_database", None), None)
         if filename is not None:
-            pl = self.parsingList.lock()
+            fs = self.fileStates.lock()
             try:
-                if filename not in pl:
+                if filename not in fs:
                     ret = True
-                    pl.append(filename)
-                    self.tasks.put((
-                        self.task_parse_database,
-                        (filename, on_done)))
+                    self.get_file_state(fs, filename).parsing = True
+                    # The options of every file depend on the database,
+                    # so it's loaded before anything else
+                    self.add_task(self.task_parse_database, (filename, on_done),
+                                  PRIORITY_FOREGROUND, filename)
             finally:
-                self.parsingList.unlock()
+                self.fileStates.unlock()
 
         return ret
 
-    def reparse(self, view, filename, unsaved_files=[], on_done=None):
-        if self.compilation_database is None:
-            self.parse_database()
+    def reparse(self, view, filename, unsaved_files=[], on_done=None, priority=PRIORITY_FOREGROUND, versions=None):
+        """
+        Reparses the translation unit with the contents of the unsaved
+        files. versions maps the open files of the translation unit to
+        the change count of their views, and defaults to the view's.
+        """
+        self.check_database()
+
+        if versions == None:
+            versions = {view.file_name(): view.change_count()}
+        # Each file has at most one reparse queued and one running. A new
+        # request replaces the queued one so that the reparse is always
+        # done with the latest contents and only the callback of the
+        # latest request is called.
+        request = (versions, self.get_opts(view, filename), self.get_opts_script(view),
+                   unsaved_files, on_done, priority)
+        fs = self.fileStates.lock()
+        try:
+            state = self.get_file_state(fs, filename)
+            queued = state.reparse != None
+            state.reparse = request
+            if queued:
+                self.set_task_priority(filename, priority)
+            elif not state.reparsing:
+                self.add_task(self.task_reparse, filename, priority, filename)
+        finally:
+            self.fileStates.unlock()
+        return True
 
-        ret = False
-        pl = self.parsingList.lock()
+    def add_reparse_time(self, filename, duration):
+        times = self.reparseTimes.lock()
         try:
-            if filename not in pl:
-                ret = True
-                pl.append(filename)
-                self.tasks.put((
-                    self.task_reparse,
-                    (filename, self.get_opts(view, filename), self.get_opts_script(view), unsaved_files, on_done)))
+            if filename in times:
+                duration = REPARSE_TIME_WEIGHT * duration + (1 - REPARSE_TIME_WEIGHT) * times[filename]
+            times[filename] = duration
         finally:
-            self.parsingList.unlock()
-        return ret
+            self.reparseTimes.unlock()
+
+    def get_reparse_time(self, filename):
+        """
+        Returns the number of seconds the file usually takes to reparse,
+        or None if it hasn't been reparsed yet.
+        """
+        times = self.reparseTimes.lock()
+        try:
+            return times.get(filename)
+        finally:
+            self.reparseTimes.unlock()
 
-    def add_ex(self, filename, opts, opts_script, on_done=None):
-        if self.compilation_database is None:
-            self.parse_database()
+    def refresh_cache(self, tu):
+        # The cache is built the first time it's needed, but once it's
+        # there it's brought up to date here rather than by the next
+        # completion, so that the update doesn't hold up the UI thread
+        tu.lock_read()
+        try:
+            if tu.cache != None:
+                tu.get_cache()
+        finally:
+            tu.unlock_read()
+
+    def save_to_disk(self, tu, filename):
+        # Only reading is needed to save it, so completions can go on
+        # while it's saved. It's not saved again if none of the files
+        # it depends on have changed since it was last saved.
+        tu.lock_read()
+        try:
+            if tu.dependencies != tu.saved_dependencies:
+                self.diskCache.save(tu.var, filename, tu.effective_opts, tu.dependencies)
+                tu.saved_dependencies = tu.dependencies
+        finally:
+            tu.unlock_read()
+
+    def get_files(self, filename):
+        """
+        Returns the normalized names of the file and of every file its
+        cached translation unit includes.
+        """
+        files = set([normalize_path(filename)])
+        tus = self.translationUnits.lock()
+        try:
+            tu = tus.get(filename)
+            if tu != None:
+                files.update([normalize_path(name) for name in tu.dependencies])
+        finally:
+            self.translationUnits.unlock()
+        return files
+
+    def is_stale(self, filename, versions, unsaved_names):
+        """
+        Returns True if the translation unit would change if it was
+        reparsed, that is if any of its open files or any of the files
+        it includes have changed since it was last parsed. versions maps
+        the open files of the translation unit to the change count of
+        their views, and unsaved_names are the ones that are modified.
+        Translation units loaded from disk are judged by the files they
+        were saved from.
+        """
+        tus = self.translationUnits.lock()
+        fs = self.fileStates.lock()
+        try:
+            tu = tus.get(filename)
+            if tu == None:
+                return True
+            if filename in fs:
+                # Already about to be parsed or reparsed
+                return False
+            parsed = dict(tu.versions)
+            dependencies = tu.dependencies
+        finally:
+            self.fileStates.unlock()
+            self.translationUnits.unlock()
+        for name, count in versions.items():
+            version = parsed.get(name)
+            if version == None:
+                if name in unsaved_names:
+                    return True
+            elif version != count:
+                return True
+        if len(unsaved_names):
+            # The buffers rather than the files on disk were parsed
+            unsaved = set([normalize_path(name) for name in unsaved_names])
+            dependencies = dict((name, mtime) for name, mtime in dependencies.items()
+                                if normalize_path(name) not in unsaved)
+        return is_modified(dependencies)
+
+    def add_ex(self, filename, opts, opts_script, on_done=None, priority=PRIORITY_BACKGROUND):
+        self.check_database()
 
         tu = self.translationUnits.lock()
-        pl = self.parsingList.lock()
+        fs = self.fileStates.lock()
         try:
-            if filename not in tu and filename not in pl:
-                pl.append(filename)
-                self.tasks.put((
-                    self.task_parse,
-                    (filename, opts, opts_script, on_done)))
+            if filename not in tu and filename not in fs:
+                self.get_file_state(fs, filename).parsing = True
+                self.add_task(self.task_parse, (filename, opts, opts_script, on_done),
+                              priority, filename)
         finally:
+            self.fileStates.unlock()
             self.translationUnits.unlock()
-            self.parsingList.unlock()
 
-    def add(self, view, filename, on_done=None):
-        if self.compilation_database is None:
-            self.parse_database()
+    def add(self, view, filename, on_done=None, priority=PRIORITY_BACKGROUND):
+        self.check_database()
 
         ret = False
         tu = self.translationUnits.lock()
-        pl = self.parsingList.lock()
+        fs = self.fileStates.lock()
         try:
-            if filename not in tu and filename not in pl:
+            if filename not in tu and filename not in fs:
                 ret = True
                 opts = self.get_opts(view, filename)
                 opts_script = self.get_opts_script(view)
-                pl.append(filename)
-                self.tasks.put((
-                    self.task_parse,
-                    (filename, opts, opts_script, on_done)))
+                self.get_file_state(fs, filename).parsing = True
+                self.add_task(self.task_parse, (filename, opts, opts_script, on_done),
+                              priority, filename)
         finally:
+            self.fileStates.unlock()
             self.translationUnits.unlock()
-            self.parsingList.unlock()
         return ret
 
+    def update_include_index(self, filename, old_dependencies, new_dependencies):
+        index = self.includedBy.lock()
+        try:
+            for name in old_dependencies:
+                if name not in new_dependencies:
+                    name = normalize_path(name)
+                    if name in index:
+                        index[name].discard(filename)
+                        if len(index[name]) == 0:
+                            del index[name]
+            for name in new_dependencies:
+                if name != filename:
+                    index.setdefault(normalize_path(name), set()).add(filename)
+        finally:
+            self.includedBy.unlock()
+
+    def reparse_dependents(self, filename, exclude=None):
+        """
+        Schedules a reparse of the cached translation units that include
+        the file, for when it has been saved. No more than
+        dependent_reparse_concurrency of them are reparsed at a time.
+        """
+        self.dependentConcurrency = max(1, get_setting("dependent_reparse_concurrency", 1))
+        index = self.includedBy.lock()
+        try:
+            dependents = [fn for fn in index.get(normalize_path(filename), []) if fn != exclude]
+        finally:
+            self.includedBy.unlock()
+        dr = self.dependentReparses.lock()
+        try:
+            for fn in dependents:
+                views = find_views(fn)
+                # Modified buffers are reparsed with their
+                # contents when the view is activated again
+                if fn not in dr and not (len(views) and views[0].is_dirty()):
+                    dr.append(fn)
+        finally:
+            self.dependentReparses.unlock()
+        self.start_dependent_reparses()
+
+    def start_dependent_reparses(self):
+        dr = self.dependentReparses.lock()
+        try:
+            if len(dr) == 0 and len(self.dependentsInFlight) == 0:
+                return
+            fs = self.fileStates.lock()
+            try:
+                for fn in list(self.dependentsInFlight):
+                    if fn not in fs:
+                        self.dependentsInFlight.discard(fn)
+            finally:
+                self.fileStates.unlock()
+            while len(dr) and len(self.dependentsInFlight) < self.dependentConcurrency:
+                fn = dr.pop(0)
+                if self.reparse_dependent(fn):
+                    self.dependentsInFlight.add(fn)
+        finally:
+            self.dependentReparses.unlock()
+
+    def reparse_dependent(self, filename):
+        tus = self.translationUnits.lock()
+        fs = self.fileStates.lock()
+        try:
+            tu = tus.get(filename)
+            if tu == None or filename in fs:
+                # Gone, or about to be parsed anyway
+                return False
+            state = self.get_file_state(fs, filename)
+            state.reparse = (None, tu.opts, tu.opts_script, [], None, PRIORITY_BACKGROUND)
+            self.add_task(self.task_reparse, filename, PRIORITY_BACKGROUND, filename)
+            return True
+        finally:
+            self.fileStates.unlock()
+            self.translationUnits.unlock()
+
+    def get_including_file(self, view, filename):
+        """
+        Returns the source file whose translation unit should be used for
+        the header, or None if the file should be parsed on its own.
+        Cached translation units including the header are preferred, and
+        the first one chosen is stuck with for as long as it's cached.
+        Otherwise a source file with the same name in the compilation
+        database is used, unless it's known not to include the header.
+        """
+        if not is_header(filename) or not get_setting("use_including_translation_unit", True, view):
+            return None
+        key = normalize_path(filename)
+        tus = self.translationUnits.lock()
+        index = self.includedBy.lock()
+        try:
+            candidates = []
+            for source in list(index.get(key, [])):
+                if source not in tus:
+                    index[key].discard(source)
+                elif not is_header(source):
+                    candidates.append(source)
+            source = self.headerSources.get(key)
+            if source not in candidates:
+                source = None
+                if len(candidates):
+                    # The cheapest to reparse when the header is modified
+                    source = min(candidates, key=lambda fn: tus[fn].memory_usage)
+                    self.headerSources[key] = source
+            if source == None and self.compilation_database != None:
+                source = self.compilation_database.find_source(filename)
+                if source in tus:
+                    # Parsed already without including the header
+                    source = None
+            return source
+        finally:
+            self.includedBy.unlock()
+            self.translationUnits.unlock()
+
     def get_opts_script(self, view):
         return expand_path(get_setting("options_script", "", view), view.window())
 
+    def invalidate_options(self):
+        """
+        Makes get_opts build the options again, for when something they
+        are built from has changed.
+        """
+        memo = self.optionsCache.lock()
+        try:
+            self.optionsGeneration += 1
+            memo.clear()
+        finally:
+            self.optionsCache.unlock()
+
+    # The settings the options are built from, which may be
+    # overridden in the settings of the view or the project
+    OPTIONS_SETTINGS = ("options", "dont_prepend_clang_includes", "add_language_option",
+                        "additional_language_options")
+
     def get_opts(self, view, filename):
-        folder = os.path.dirname(filename)
-        if folder in self.compilation_database:
-            opts = list(self.compilation_database[folder])
+        window = view.window()
+        # Changes to the view or project settings don't invalidate the
+        # memo, so they are part of the key
+        settings = json.dumps([get_setting(k, None, view) for k in TranslationUnitCache.OPTIONS_SETTINGS], sort_keys=True)
+        key = (filename, window.id() if window != None else None, get_language(view), settings)
+        if includePathCache.check():
+            # A directory has been added to or removed from an expanded
+            # include path, which the memoized options don't know about
+            self.invalidate_options()
+        memo = self.optionsCache.lock()
+        try:
+            generation = self.optionsGeneration
+            if key in memo:
+                return memo[key]
+        finally:
+            self.optionsCache.unlock()
+
+        opts = CompileOptions(self.build_opts(view, filename))
+        opts.get_fingerprint()
+        memo = self.optionsCache.lock()
+        try:
+            if generation == self.optionsGeneration:
+                memo[key] = opts
+        finally:
+            self.optionsCache.unlock()
+        return opts
+
+    def build_opts(self, view, filename):
+        opts = self.compilation_database.get_opts(filename)
+        if opts != None:
+            opts = list(opts)
         else:
-            self.set_status('%s not in compilation database' % folder)
+            self.set_status('%s not in compilation database' % filename)
             opts = get_path_setting("options", [], view)
 
         if not get_setting("dont_prepend_clang_includes", False, view):
@@ -887,6 +1780,9 @@ class TranslationUnitCache(Worker):
 
         if get_setting("add_language_option", True, view):
             language = get_language(view)
+            if filename != view.file_name():
+                # A source file parsed for the header open in the view
+                language = SOURCE_LANGUAGES.get(os.path.splitext(filename)[1].lower(), "c++")
             if language == "objc":
                 opts.append("-ObjC")
             elif language == "objc++":
@@ -897,48 +1793,81 @@ class TranslationUnitCache(Worker):
             additional_language_options = get_setting("additional_language_options", {}, view)
             if additional_language_options.has_key(language):
                 opts.extend(additional_language_options[language] or [])
+        return opts
 
+    def load_settings(self, view=None):
+        """
+        Loads the settings of the cache itself, which may be overridden
+        in the project of the view. Called when the settings change and
+        when a view is activated, since that may be in another project.
+        """
+        window = view.window() if view != None else None
         self.debug_options = get_setting("debug_options", False)
         self.index_parse_options = get_setting("index_parse_options", 13, view)
-        return opts
-
-    def get_translation_unit(self, filename, opts=[], opts_script=None, unsaved_files=[]):
+        memory_budget = get_setting("cache_memory_budget", 0, view) * 1024 * 1024
+        self.evict_open_views = get_setting("cache_evict_open_views", False, view)
+        self.diskCache.path = expand_path(get_setting("ast_cache_path", "", view), window)
+        self.diskCache.max_size = get_setting("ast_cache_size", 1024, view) * 1024 * 1024
+        self.optionsScriptCache.ttl = get_setting("options_script_cache_ttl", 300, view)
+        self.optionsScriptCache.dependencies = [expand_path(d, window) for d in get_setting("options_script_dependencies", [], view)]
+        self.optionsScriptCache.batch = get_setting("options_script_batch", False, view)
+        if memory_budget != self.memory_budget:
+            self.memory_budget = memory_budget
+            self.add_task(self.task_evict, None, PRIORITY_SEARCH)
+
+    def get_translation_unit(self, filename, opts=[], opts_script=None, unsaved_files=[], use_disk_cache=True, check_options=True):
+        """
+        Returns the cached translation unit of the file, or parses it with
+        the options if it isn't cached. A cached translation unit built
+        with other options is dropped and parsed again, unless
+        check_options is False, as for searches that only read from it
+        and may not know the options the file is compiled with.
+        """
         if self.index == None:
             self.index = cindex.Index.create()
         tu = None
         tus = self.translationUnits.lock()
         if filename not in tus:
             self.translationUnits.unlock()
+            fingerprint = get_fingerprint(opts)
             pre_script_opts = list(opts)
+            opts = list(opts)
 
             if opts_script:
-                # shlex.split barfs if fed with an unicode strings
-                args = shlex.split(opts_script.encode()) + [filename]
-                process = subprocess.Popen(args, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-                output = process.communicate()
-                if process.returncode:
-                    print "The options_script failed with code [%s]" % process.returncode
-                    print output[1]
-                else:
-                    opts += shlex.split(output[0])
+                opts += self.optionsScriptCache.get(opts_script, filename)
 
             if self.debug_options:
                 print "Will compile file %s with the following options:\n%s" % (filename, opts)
 
             opts.append(filename)
-            tu = self.index.parse(None, opts, unsaved_files,
-                                  self.index_parse_options)
+            from_disk = False
+            tu = None
+            if use_disk_cache and len(unsaved_files) == 0:
+                tu = self.diskCache.load(self.index, filename, opts)
+                from_disk = tu != None
+            if tu == None:
+                tu = self.index.parse(None, opts, unsaved_files,
+                                      self.index_parse_options)
             if tu != None:
                 tu = TranslationUnitCache.LockedTranslationUnit(tu, filename)
                 tu.opts = pre_script_opts
+                tu.opts_script = opts_script
+                tu.fingerprint = fingerprint
+                tu.effective_opts = opts
+                tu.from_disk = from_disk
+                if not from_disk and len(unsaved_files) == 0:
+                    self.diskCache.save(tu.var, filename, opts, tu.dependencies)
+                    tu.saved_dependencies = tu.dependencies
                 tus = self.translationUnits.lock()
                 tus[filename] = tu
+                self.update_include_index(filename, {}, tu.dependencies)
                 self.translationUnits.unlock()
             else:
                 print "tu is None..."
         else:
             tu = tus[filename]
-            recompile = tu.opts != opts
+            tu.last_used = time.time()
+            recompile = check_options and tu.fingerprint != get_fingerprint(opts)
 
             if recompile:
                 del tus[filename]
@@ -946,13 +1875,43 @@ class TranslationUnitCache(Worker):
 
             if recompile:
                 self.set_status("Options change detected. Will recompile %s" % filename)
-                self.add_ex(filename, opts, opts_script, None)
+                self.add_ex(filename, opts, opts_script, None, PRIORITY_VISIBLE)
         return tu
 
-    def remove(self, filename):
-        self.tasks.put((self.task_remove, filename))
+    def set_priority(self, filename, priority):
+        self.set_task_priority(filename, priority)
+
+    def cancel(self, filename):
+        """
+        Cancels any parse or reparse of the file that hasn't been
+        started yet.
+        """
+        tasks = self.cancel_tasks(filename)
+        fs = self.fileStates.lock()
+        try:
+            if filename in fs:
+                state = fs[filename]
+                state.reparse = None
+                for task in tasks:
+                    if task.func == self.task_parse:
+                        state.parsing = False
+                self.release_file_state(fs, filename)
+        finally:
+            self.fileStates.unlock()
+
+    def remove(self, filename, priority=PRIORITY_BACKGROUND):
+        self.cancel(filename)
+        self.add_task(self.task_remove, filename, priority, filename)
+
+    def prefetch_options(self, opts_script, filenames):
+        if opts_script:
+            self.optionsScriptCache.prefetch(opts_script, filenames)
 
     def clear(self):
-        self.tasks.put((self.task_clear, None))
+        # The settings might have changed, so the options
+        # could be different now
+        self.invalidate_options()
+        self.optionsScriptCache.clear()
+        self.add_task(self.task_clear, None, PRIORITY_FOREGROUND)
 
 tuCache = TranslationUnitCache()
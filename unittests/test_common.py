@@ -0,0 +1,225 @@
+"""
+Tests of the threading primitives in common.py. They don't need libclang
+or sublime, and are run from the root of the package with
+
+    python -m unittest discover -s unittests -p "test_*.py"
+"""
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import threading
+import time
+import unittest
+
+from common import ReadWriteLock, TaskQueue, TimerScheduler, ExecutionBudget, \
+                   PRIORITY_FOREGROUND, PRIORITY_VISIBLE, PRIORITY_BACKGROUND, \
+                   POOL_TRANSLATION_UNIT, POOL_ANALYZER, POOL_SEARCH
+
+
+def wait_for(condition, timeout=2.0):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class ReadWriteLockTest(unittest.TestCase):
+    def test_readers_share(self):
+        lock = ReadWriteLock()
+        self.assertTrue(lock.acquire_read(False))
+        self.assertTrue(lock.acquire_read(False))
+        self.assertFalse(lock.acquire(False))
+        lock.release_read()
+        lock.release_read()
+        self.assertTrue(lock.acquire(False))
+        lock.release()
+
+    def test_writer_excludes_readers(self):
+        lock = ReadWriteLock()
+        lock.acquire()
+        self.assertFalse(lock.acquire_read(False))
+        self.assertFalse(lock.acquire(False))
+        lock.release()
+        self.assertTrue(lock.acquire_read(False))
+        lock.release_read()
+
+    def test_waiting_writer_goes_before_new_readers(self):
+        lock = ReadWriteLock()
+        lock.acquire_read()
+        acquired = threading.Event()
+
+        def writer():
+            lock.acquire()
+            acquired.set()
+            lock.release()
+        t = threading.Thread(target=writer)
+        t.start()
+        self.assertTrue(wait_for(lambda: lock.waiting_writers == 1))
+        # A reader coming along now has to wait for the writer
+        self.assertFalse(lock.acquire_read(False))
+        self.assertFalse(acquired.is_set())
+        lock.release_read()
+        t.join(2)
+        self.assertTrue(acquired.is_set())
+        self.assertTrue(lock.acquire_read(False))
+        lock.release_read()
+
+
+class TaskQueueTest(unittest.TestCase):
+    def test_priority_order(self):
+        queue = TaskQueue()
+        queue.put("background", priority=PRIORITY_BACKGROUND)
+        queue.put("visible1", priority=PRIORITY_VISIBLE)
+        queue.put("foreground", priority=PRIORITY_FOREGROUND)
+        queue.put("visible2", priority=PRIORITY_VISIBLE)
+        order = [queue.get().func for i in range(4)]
+        self.assertEqual(order, ["foreground", "visible1", "visible2", "background"])
+        self.assertTrue(queue.empty())
+
+    def test_set_priority(self):
+        queue = TaskQueue()
+        queue.put("a", priority=PRIORITY_VISIBLE, key="a")
+        queue.put("b", priority=PRIORITY_BACKGROUND, key="b")
+        queue.set_priority("b", PRIORITY_FOREGROUND)
+        self.assertEqual(queue.get().func, "b")
+        self.assertEqual(queue.get().func, "a")
+        self.assertTrue(queue.empty())
+
+    def test_busy_key_blocks(self):
+        queue = TaskQueue()
+        queue.put("first", priority=PRIORITY_FOREGROUND, key="file")
+        queue.put("second", priority=PRIORITY_FOREGROUND, key="file")
+        queue.put("other", priority=PRIORITY_BACKGROUND, key="other")
+        first = queue.get()
+        self.assertEqual(first.func, "first")
+        # The second task of the file has to wait for the first one
+        other = queue.get()
+        self.assertEqual(other.func, "other")
+        queue.task_done(other)
+        queue.task_done(first)
+        self.assertEqual(queue.get().func, "second")
+        self.assertTrue(queue.empty())
+
+    def test_blocked_task_is_handed_out_when_key_is_done(self):
+        queue = TaskQueue()
+        queue.put("first", key="file")
+        queue.put("second", key="file")
+        first = queue.get()
+        got = []
+        t = threading.Thread(target=lambda: got.append(queue.get()))
+        t.daemon = True
+        t.start()
+        time.sleep(0.05)
+        self.assertEqual(got, [])
+        queue.task_done(first)
+        t.join(2)
+        self.assertEqual([task.func for task in got], ["second"])
+
+    def test_cancel(self):
+        queue = TaskQueue()
+        queue.put("cancelled1", key="file")
+        queue.put("kept", key="other")
+        queue.put("cancelled2", key="file")
+        tasks = queue.cancel("file")
+        self.assertEqual([task.func for task in tasks], ["cancelled1", "cancelled2"])
+        self.assertEqual(queue.cancel("file"), [])
+        self.assertEqual(queue.get().func, "kept")
+        self.assertTrue(queue.empty())
+
+
+class TimerSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = TimerScheduler()
+        self.calls = []
+        self.called = threading.Event()
+
+    def call(self, name):
+        self.calls.append((name, time.time()))
+        self.called.set()
+
+    def test_calls_in_time_order(self):
+        self.scheduler.schedule(0.1, self.call, "later")
+        self.scheduler.schedule(0.02, self.call, "sooner")
+        self.assertTrue(wait_for(lambda: len(self.calls) == 2))
+        self.assertEqual([name for name, when in self.calls], ["sooner", "later"])
+
+    def test_cancel(self):
+        call = self.scheduler.schedule(0.05, self.call, "cancelled")
+        call.cancel()
+        self.scheduler.schedule(0.1, self.call, "kept")
+        self.assertTrue(self.called.wait(2))
+        time.sleep(0.05)
+        self.assertEqual([name for name, when in self.calls], ["kept"])
+
+    def test_reschedule(self):
+        start = time.time()
+        call = self.scheduler.schedule(0.05, self.call, "moved")
+        call.reschedule(0.2)
+        self.assertTrue(self.called.wait(2))
+        self.assertEqual(len(self.calls), 1)
+        self.assertTrue(self.calls[0][1] - start >= 0.2)
+
+
+class ExecutionBudgetTest(unittest.TestCase):
+    def create(self, limit, quotas={}):
+        budget = ExecutionBudget()
+        budget.limit = limit
+        budget.quotas = dict(quotas)
+        return budget
+
+    def test_limit(self):
+        budget = self.create(2)
+        budget.acquire(POOL_TRANSLATION_UNIT)
+        budget.acquire(POOL_TRANSLATION_UNIT)
+        self.assertFalse(budget.can_run(POOL_TRANSLATION_UNIT))
+        budget.release(POOL_TRANSLATION_UNIT)
+        self.assertTrue(budget.can_run(POOL_TRANSLATION_UNIT))
+
+    def test_quota(self):
+        budget = self.create(4, {POOL_ANALYZER: 1})
+        budget.acquire(POOL_ANALYZER)
+        self.assertFalse(budget.can_run(POOL_ANALYZER))
+        self.assertTrue(budget.can_run(POOL_SEARCH))
+
+    def test_slot_reserved_for_translation_units(self):
+        budget = self.create(3)
+        budget.acquire(POOL_ANALYZER)
+        budget.acquire(POOL_SEARCH)
+        # The other pools together get all but one slot
+        self.assertFalse(budget.can_run(POOL_ANALYZER))
+        self.assertFalse(budget.can_run(POOL_SEARCH))
+        self.assertTrue(budget.can_run(POOL_TRANSLATION_UNIT))
+
+    def test_single_slot_isnt_reserved(self):
+        budget = self.create(1, {POOL_ANALYZER: 1})
+        self.assertTrue(budget.can_run(POOL_ANALYZER))
+        budget.acquire(POOL_ANALYZER)
+        self.assertFalse(budget.can_run(POOL_TRANSLATION_UNIT))
+        budget.release(POOL_ANALYZER)
+        self.assertTrue(budget.can_run(POOL_TRANSLATION_UNIT))
+
+    def test_freed_slot_goes_to_highest_priority(self):
+        budget = self.create(1)
+        budget.acquire(POOL_TRANSLATION_UNIT)
+        order = []
+
+        def job(priority, name):
+            budget.acquire(POOL_TRANSLATION_UNIT, priority)
+            order.append(name)
+            budget.release(POOL_TRANSLATION_UNIT)
+        threads = [threading.Thread(target=job, args=(PRIORITY_BACKGROUND, "background"))]
+        threads[0].start()
+        self.assertTrue(wait_for(lambda: len(budget.waiting) == 1))
+        threads.append(threading.Thread(target=job, args=(PRIORITY_FOREGROUND, "foreground")))
+        threads[1].start()
+        self.assertTrue(wait_for(lambda: len(budget.waiting) == 2))
+        budget.release(POOL_TRANSLATION_UNIT)
+        for t in threads:
+            t.join(2)
+        self.assertEqual(order, ["foreground", "background"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+"""
+Tests of compilationdatabase.py, run from the root of the package with
+
+    python -m unittest discover -s unittests -p "test_*.py"
+"""
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import json
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from compilationdatabase import iter_entries, CompilationDatabase
+
+
+ENTRIES = [
+    {"directory": "/src", "command": "c++ -DONE -Iinclude -c a.cpp", "file": "a.cpp"},
+    {"directory": "/src", "arguments": ["c++", "-DTWO", "-c", "b.cpp"], "file": "b.cpp"},
+    {"directory": "/src/sub", "command": "cc -O2 -c \"c, d].c\"", "file": "c, d].c"}
+]
+
+
+class IterEntriesTest(unittest.TestCase):
+    def entries(self, data, chunk_size=1 << 16):
+        return list(iter_entries(StringIO(data), chunk_size))
+
+    def test_whole_file(self):
+        self.assertEqual(self.entries(json.dumps(ENTRIES)), ENTRIES)
+
+    def test_entries_split_across_chunks(self):
+        data = json.dumps(ENTRIES, indent=4)
+        for chunk_size in (1, 2, 7, 64):
+            self.assertEqual(self.entries(data, chunk_size), ENTRIES)
+
+    def test_empty(self):
+        self.assertEqual(self.entries(""), [])
+        self.assertEqual(self.entries(" \n"), [])
+        self.assertEqual(self.entries("[]"), [])
+        self.assertEqual(self.entries(" [ \n ] "), [])
+
+    def test_not_an_array(self):
+        self.assertRaises(ValueError, self.entries, json.dumps(ENTRIES[0]))
+        self.assertRaises(ValueError, self.entries, "garbage")
+
+    def test_truncated(self):
+        data = json.dumps(ENTRIES)
+        # Cut inside an entry, between two entries and before the final ]
+        for end in (1, 20, data.index("}") + 1, data.index("}") + 2, len(data) - 1):
+            for chunk_size in (1, 16, 1 << 16):
+                self.assertRaises(ValueError, self.entries, data[:end], chunk_size)
+
+    def test_entries_before_truncation_are_yielded(self):
+        data = json.dumps(ENTRIES)
+        entries = iter_entries(StringIO(data[:-10]), 8)
+        self.assertEqual(next(entries), ENTRIES[0])
+        self.assertEqual(next(entries), ENTRIES[1])
+        self.assertRaises(ValueError, next, entries)
+
+
+class CountingDatabase(CompilationDatabase):
+    def __init__(self):
+        CompilationDatabase.__init__(self)
+        self.parsed = []
+
+    def get_flags(self, entry):
+        self.parsed.append(entry["file"])
+        return CompilationDatabase.get_flags(self, entry)
+
+
+class CompilationDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "compile_commands.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, entries):
+        f = open(self.filename, "w")
+        try:
+            json.dump(entries, f)
+        finally:
+            f.close()
+
+    def entry(self, name, flags):
+        return {"directory": self.dir, "command": "c++ %s -c %s" % (flags, name), "file": name}
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def test_flags(self):
+        self.write([self.entry("a.cpp", "-DA -Iinclude -O2"), self.entry("b.cpp", "-DA -DB")])
+        db = CompilationDatabase()
+        db.load(self.filename)
+        self.assertEqual(db.get_opts(self.path("a.cpp")), ("-DA", "-I" + self.path("include"), "-O2"))
+        # A header gets the flags of all the files in its directory
+        self.assertEqual(db.get_opts(self.path("a.h")), ("-DA", "-I" + self.path("include"), "-O2", "-DB"))
+        self.assertEqual(db.get_opts(os.path.join(self.dir, "other", "c.cpp")), None)
+        self.assertEqual(db.find_source(self.path("b.h")), os.path.normcase(self.path("b.cpp")))
+        self.assertEqual(db.find_source(self.path("c.h")), None)
+
+    def test_identical_flags_are_shared(self):
+        self.write([self.entry("a.cpp", "-DA"), self.entry("b.cpp", "-DA")])
+        db = CompilationDatabase()
+        db.load(self.filename)
+        self.assertTrue(db.get_opts(self.path("a.cpp")) is db.get_opts(self.path("b.cpp")))
+
+    def test_reload_parses_changed_entries_only(self):
+        self.write([self.entry("a.cpp", "-DA"), self.entry("b.cpp", "-DB"), self.entry("c.cpp", "-DC")])
+        db = CountingDatabase()
+        db.load(self.filename)
+        self.assertEqual(sorted(db.parsed), ["a.cpp", "b.cpp", "c.cpp"])
+        self.assertFalse(db.is_modified(self.filename))
+
+        del db.parsed[:]
+        self.write([self.entry("a.cpp", "-DA"), self.entry("b.cpp", "-DCHANGED"), self.entry("d.cpp", "-DD")])
+        db.load(self.filename)
+        self.assertEqual(sorted(db.parsed), ["b.cpp", "d.cpp"])
+        self.assertEqual(db.get_opts(self.path("a.cpp")), ("-DA",))
+        self.assertEqual(db.get_opts(self.path("b.cpp")), ("-DCHANGED",))
+        self.assertEqual(db.get_opts(self.path("d.cpp")), ("-DD",))
+        # Removed files are gone, both their flags and from the headers' flags
+        self.assertEqual(db.get_opts(self.path("c.cpp")), ("-DA", "-DCHANGED", "-DD"))
+        self.assertFalse(self.path("c.cpp") in db.files)
+
+    def test_other_database_starts_over(self):
+        self.write([self.entry("a.cpp", "-DA")])
+        db = CountingDatabase()
+        db.load(self.filename)
+        other = os.path.join(self.dir, "other.json")
+        shutil.copy(self.filename, other)
+        self.assertTrue(db.is_modified(other))
+        del db.parsed[:]
+        db.load(other)
+        self.assertEqual(db.parsed, ["a.cpp"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -71,7 +71,7 @@ def add_test(currtest, platformspecific=False, noneok=False):
 
     output = None
     if dn or not debugnew:
-        output = tu.cache.complete(currtest, "")
+        output = tu.get_cache().complete(currtest, "")
     if output:
         new = []
         for name in output: